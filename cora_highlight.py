@@ -0,0 +1,168 @@
+'''
+ # @ Author: Jie Yang
+ # @ Create Time: 2024.6
+ # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
+ '''
+# -*- coding: utf-8 -*-
+## highlighting of the note view, drawn as an overlay on the blocks that are shown
+import bisect
+from PyQt5.QtCore import QObject, QPoint, QTimer
+from PyQt5.QtGui import QTextCharFormat, QTextCursor
+from PyQt5.QtWidgets import QTextEdit
+
+
+class SpanHighlighter(QObject):
+    ## draws the highlight layers (keywords, titles, search hits) of a text edit as extra selections, an overlay
+    ## kept apart from the formats of the document: a highlight change does not touch the document, its layout or
+    ## its undo stack. only the spans of the blocks in the viewport, and a page above and below it, are turned into
+    ## selections, so the cost of a highlight follows the number of shown hits, not the length of the document.
+    ## the spans of a layer are either (start, length) in the document, e.g. precomputed with the view, or a
+    ## function from the text of a block to its (start, length), run when the block is shown
+    def __init__(self, text_edit, margin_pages=1):
+        super().__init__(text_edit)
+        self.text_edit = text_edit
+        self.margin_pages = margin_pages  # pages above and below the viewport that are highlighted as well
+        self.layers = {}  # name -> (format, spans, span starts, longest span, spans as given), merged in insertion order
+        self.block_segments = {}  # block number -> (start, end, layer names) of the block for the current layers
+        self.merged_formats = {}  # layer names -> merged format of the layers
+        self.update_timer = QTimer()
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(0)
+        self.update_timer.timeout.connect(self.update_viewport)
+        text_edit.verticalScrollBar().valueChanged.connect(self.schedule_update)
+        text_edit.verticalScrollBar().rangeChanged.connect(self.schedule_update)
+        text_edit.document().contentsChange.connect(self.on_contents_change)
+
+    def document(self):
+        return self.text_edit.document()
+
+    def set_layer(self, name, highlight_format, spans):
+        self.layers[name] = self.layer(highlight_format, spans)
+        self.invalidate()
+
+    def replace_spans(self, name, spans):
+        ## same highlight from another source, e.g. the spans of the whole text in place of the per block function,
+        ## the shown selections stay as they are
+        if name in self.layers:
+            self.layers[name] = self.layer(self.layers[name][0], spans)
+
+    def update_spans(self, name, spans):
+        ## changed spans of a layer, e.g. for an edited keyword set: only the blocks where spans were added or
+        ## removed are looked up again, the others keep their segments
+        highlight_format, old_spans = self.layers[name][:2]
+        self.layers[name] = self.layer(highlight_format, spans)
+        if callable(old_spans) or callable(spans):
+            self.invalidate()
+            return
+        document = self.document()
+        for start, length in set(old_spans).symmetric_difference(self.layers[name][1]):
+            first = document.findBlock(start).blockNumber()
+            last = document.findBlock(start + max(length - 1, 0)).blockNumber()
+            for block_number in range(first, last + 1):
+                self.block_segments.pop(block_number, None)
+        self.schedule_update()
+
+    def layer(self, highlight_format, spans):
+        if callable(spans):
+            return (highlight_format, spans, None, 0, spans)
+        sorted_spans = sorted(spans)
+        return (highlight_format, sorted_spans, [start for start, length in sorted_spans], max((length for start, length in sorted_spans), default=0), spans)
+
+    def layer_spans(self, name):
+        ## the spans a layer was set with, None without the layer
+        layer = self.layers.get(name)
+        return None if layer is None else layer[4]
+
+    def clear_layer(self, name):
+        if self.layers.pop(name, None) is not None:
+            self.invalidate()
+
+    def invalidate(self):
+        ## the selections of the shown blocks are put together again on the next pass of the event loop
+        self.block_segments = {}
+        self.merged_formats = {}
+        self.schedule_update()
+
+    def schedule_update(self):
+        ## update the selections on the next pass of the event loop, after the scrolling or layout settled
+        self.update_timer.start()
+
+    def on_contents_change(self, position, chars_removed, chars_added):
+        ## the text changed (e.g. a new view was shown), the spans of the blocks are looked up again
+        self.block_segments = {}
+        self.schedule_update()
+
+    def visible_blocks(self):
+        ## first and last block number in the viewport
+        viewport = self.text_edit.viewport()
+        margin = int(self.document().documentMargin()) + 1  # a point in the top margin does not hit the first block
+        first = self.text_edit.cursorForPosition(QPoint(margin, margin)).blockNumber()
+        last = self.text_edit.cursorForPosition(QPoint(viewport.width() - 1, viewport.height() - 1)).blockNumber()
+        return first, last
+
+    def update_viewport(self):
+        ## one extra selection per highlighted segment of the blocks in and around the viewport. where the spans of
+        ## layers overlap their formats are merged into one segment, the selections are drawn one over another
+        first, last = self.visible_blocks()
+        page = last - first + 1
+        block = self.document().findBlockByNumber(max(0, first - page * self.margin_pages))
+        last += page * self.margin_pages
+        selections = []
+        while block.isValid() and block.blockNumber() <= last:
+            segments = self.block_segments.get(block.blockNumber())
+            if segments is None:
+                segments = self.segments(block)
+                self.block_segments[block.blockNumber()] = segments
+            for start, end, names in segments:
+                selection = QTextEdit.ExtraSelection()
+                selection.cursor = QTextCursor(block)
+                selection.cursor.setPosition(block.position() + start)
+                selection.cursor.setPosition(block.position() + end, QTextCursor.KeepAnchor)
+                selection.format = self.merged_format(names)
+                selections.append(selection)
+            block = block.next()
+        self.text_edit.setExtraSelections(selections)
+
+    def block_spans(self, block, text):
+        ## (start, end, layer name) of the layer spans in the block, in block coordinates
+        block_start = block.position()
+        block_end = block_start + len(text)
+        segments = []
+        for name, (highlight_format, spans, starts, longest, given_spans) in self.layers.items():
+            if starts is None:
+                segments += [(start, start + length, name) for start, length in spans(text)]
+                continue
+            index = bisect.bisect_left(starts, block_start - longest)
+            while index < len(spans) and spans[index][0] < block_end:
+                start, length = spans[index]
+                if start + length > block_start:
+                    segments.append((max(start, block_start) - block_start, min(start + length, block_end) - block_start, name))
+                index += 1
+        return segments
+
+    def segments(self, block):
+        ## (start, end, layer names) of the highlighted parts of the block, without overlaps
+        events = []
+        for start, end, name in self.block_spans(block, block.text()):
+            events += [(start, 1, name), (end, -1, name)]
+        events.sort()
+        active = dict.fromkeys(self.layers, 0)
+        segments = []
+        position = 0
+        for bound, change, name in events:
+            if bound > position:
+                names = tuple(name for name, count in active.items() if count)
+                if names:
+                    segments.append((position, bound, names))
+                position = bound
+            active[name] += change
+        return segments
+
+    def merged_format(self, names):
+        highlight_format = self.merged_formats.get(names)
+        if highlight_format is None:
+            highlight_format = QTextCharFormat()
+            for name in names:
+                highlight_format.merge(self.layers[name][0])
+            self.merged_formats[names] = highlight_format
+        return highlight_format
@@ -0,0 +1,416 @@
+'''
+ # @ Author: Jie Yang
+ # @ Create Time: 2024.6
+ # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
+ '''
+# -*- coding: utf-8 -*-
+## data ingestion helpers shared by cora.py, cora_large_file.py and cora_uc2.py
+import io
+import os
+import sys
+import csv
+import json
+import mmap
+import bz2
+import gzip
+import lzma
+import bisect
+from array import array
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+try:
+    import zstandard  # optional, only needed for .zst input
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow.parquet as pq  # optional, only needed for .parquet input
+except ImportError:
+    pq = None
+
+## compressed input is detected from the first bytes of the file, not from its name
+COMPRESSION_MAGIC = [('gzip', b'\x1f\x8b'), ('bz2', b'BZh'), ('xz', b'\xfd7zXZ\x00'), ('zstd', b'\x28\xb5\x2f\xfd')]
+COMPRESSION_SUFFIXES = ['.gz', '.bz2', '.xz', '.zst']
+
+
+def iter_xml_row_index(file_obj, column_names=None, lazy_columns=('Record',), chunk_size=1 << 16, resume=0):
+    ## one pass over a CORA xml file (binary file object) that only keeps the metadata columns.
+    ## yields (record, start, end_tag) for every top-level ROW, where start is the byte offset of <ROW>
+    ## and end_tag the byte offset of its closing tag. lazy_columns are not read, their value is left
+    ## empty and can be read later from the byte range with XmlRowSource.
+    ## resume is the start of a ROW to begin the scan at, the rows before it are not read.
+    if column_names is None:
+        column_names = []
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    state = {'depth': 0, 'record': None, 'start': 0, 'name': None, 'text': None, 'offset': 0}
+    rows = []
+
+    def start_element(tag, attrs):
+        state['depth'] += 1
+        if state['depth'] == 2 and tag == 'ROW':
+            state['record'] = {}
+            state['start'] = parser.CurrentByteIndex + state['offset']
+        elif state['depth'] == 3 and tag == 'COLUMN' and state['record'] is not None:
+            name = sys.intern(attrs.get('NAME') or '')  # one key object shared by all records
+            if name not in column_names:
+                column_names.append(name)
+            state['name'] = name
+            state['text'] = None if name in lazy_columns else []
+
+    def end_element(tag):
+        if state['depth'] == 3 and state['name'] is not None:
+            text = state['text']
+            state['record'][state['name']] = "".join(text).strip() if text else ""
+            state['name'] = None
+            state['text'] = None
+        elif state['depth'] == 2 and state['record'] is not None:
+            rows.append((state['record'], state['start'], parser.CurrentByteIndex + state['offset']))
+            state['record'] = None
+        state['depth'] -= 1
+
+    def character_data(data):
+        if state['text'] is not None and state['depth'] == 3:
+            state['text'].append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    if resume:
+        ## the head of the file (declaration and root tag) is parsed first, so the rows from resume on are still one document
+        data = b""
+        while b"<ROW" not in data:
+            chunk = file_obj.read(chunk_size)
+            if not chunk:
+                break
+            data += chunk
+        index = data.find(b"<ROW")
+        head = data[:index] if index >= 0 else data
+        state['offset'] = resume - len(head)
+        if resume < len(data):
+            head += data[resume:]
+        else:
+            file_obj.seek(resume)
+        parser.Parse(head, False)
+    while True:
+        data = file_obj.read(chunk_size)
+        parser.Parse(data, not data)
+        for row in rows:
+            yield row
+        del rows[:]
+        if not data:
+            break
+
+
+def column_value(value):
+    ## cell of a jsonl/csv/parquet row as the string a CORA xml COLUMN would hold
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value).strip()
+
+
+def iter_jsonl_row_index(file_obj, column_names=None, lazy_columns=('Record',), resume=0):
+    ## one json object per line, same (record, start, end) rows as iter_xml_row_index,
+    ## start and end are the byte range of the line
+    if column_names is None:
+        column_names = []
+    if resume:
+        file_obj.seek(resume)
+    position = resume
+    for line in file_obj:
+        start = position
+        position += len(line)
+        if not line.strip():
+            continue
+        record = {}
+        for name, value in json.loads(line).items():
+            name = sys.intern(name)
+            if name not in column_names:
+                column_names.append(name)
+            record[name] = "" if name in lazy_columns else column_value(value)
+        yield record, start, position
+
+
+def iter_csv_row_index(file_obj, column_names=None, lazy_columns=(), resume=0):
+    ## csv with a header line. Quoted cells may hold line breaks so rows have no usable byte range,
+    ## note bodies are always read here (lazy_columns is ignored) and start/end is the row number
+    if column_names is None:
+        column_names = []
+    text = io.TextIOWrapper(file_obj, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.reader(text)
+        header = [sys.intern(name.strip()) for name in next(reader, [])]
+        for name in header:
+            if name not in column_names:
+                column_names.append(name)
+        for row_index, row in enumerate(reader):
+            if not row or row_index < resume:
+                continue
+            yield {name: column_value(value) for name, value in zip(header, row)}, row_index, row_index + 1
+    finally:
+        text.detach()  # the file object belongs to the caller, do not close it with the wrapper
+
+
+def iter_parquet_row_index(file_obj, column_names=None, lazy_columns=('Record',), batch_size=10000, resume=0):
+    ## only the metadata columns are read, start/end is the row number which ParquetRowSource
+    ## uses to read the lazy columns later, one row group at a time
+    if pq is None:
+        raise ValueError("Reading .parquet files requires the pyarrow package (pip install pyarrow).")
+    if column_names is None:
+        column_names = []
+    parquet_file = pq.ParquetFile(file_obj)
+    names = [sys.intern(name) for name in parquet_file.schema_arrow.names]
+    for name in names:
+        if name not in column_names:
+            column_names.append(name)
+    read_names = [name for name in names if name not in lazy_columns]
+    ## row groups before the resume row are skipped without reading them
+    row_index = 0
+    first_group = 0
+    while first_group < parquet_file.num_row_groups and row_index + parquet_file.metadata.row_group(first_group).num_rows <= resume:
+        row_index += parquet_file.metadata.row_group(first_group).num_rows
+        first_group += 1
+    row_groups = list(range(first_group, parquet_file.num_row_groups))
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=read_names):
+        for row in batch.to_pylist():
+            if row_index < resume:
+                row_index += 1
+                continue
+            record = {name: "" for name in names}
+            for name in read_names:
+                record[name] = column_value(row[name])
+            yield record, row_index, row_index + 1
+            row_index += 1
+
+
+def compression_of(file_path):
+    ## name of the compression of a file, None for plain xml
+    with open(file_path, 'rb') as f:
+        head = f.read(6)
+    for name, magic in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def open_input(file_obj, compression):
+    ## wrap a binary file object so that compressed input is decoded while it is read, no temporary file is written.
+    ## file_obj.tell() still gives the compressed bytes read, which is what the progress bar shows
+    if compression is None:
+        return file_obj
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file_obj, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(file_obj, mode='rb')
+    if compression == 'xz':
+        return lzma.LZMAFile(file_obj, mode='rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("Reading .zst files requires the zstandard package (pip install zstandard).")
+        return zstandard.ZstdDecompressor().stream_reader(file_obj)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def reader_of(file_path):
+    ## entry of READERS for a file, chosen by extension (after any compression suffix), xml by default
+    base, ext = os.path.splitext(file_path.lower())
+    if ext in COMPRESSION_SUFFIXES:
+        ext = os.path.splitext(base)[1]
+    return READERS.get(ext, READERS['.xml'])
+
+
+def is_lazy(file_path):
+    ## note bodies can be read back later only from an uncompressed file with a row source
+    reader = reader_of(file_path)
+    return reader['source'] is not None and (reader['seekable'] or compression_of(file_path) is None)
+
+
+def dataset_lazy_columns(file_paths):
+    ## columns left in the files of a dataset, read back through its row source. decided for the dataset as a
+    ## whole, as open_row_source does: a shard that can not be read back makes every shard keep its note bodies
+    return ('Record',) if all(is_lazy(file_path) for file_path in file_paths) else ()
+
+
+def iter_file_rows(file_obj, file_path, column_names=None, resume=0, lazy_columns=None):
+    ## (record, start, end) of every row of a CORA data file of any supported format, file_obj is the opened
+    ## binary file. Metadata columns only when the note bodies can be read back lazily, see open_row_source;
+    ## lazy_columns of the dataset the file is a shard of, of the file alone by default.
+    ## resume is the start of a row already read, the scan begins at that row (used to read appended rows)
+    reader = reader_of(file_path)
+    if lazy_columns is None:
+        lazy_columns = dataset_lazy_columns([file_path])
+    if reader['seekable']:
+        return reader['scan'](file_obj, column_names, lazy_columns, resume=resume)
+    return reader['scan'](open_input(file_obj, compression_of(file_path)), column_names, lazy_columns, resume=resume)
+
+
+def scan_shard(file_path, lazy_columns=()):
+    ## metadata scan of one shard, run in a worker process of the folder loader. lazy_columns of the whole
+    ## folder, see dataset_lazy_columns. returns (records, row starts, row ends), all picklable.
+    records = []
+    starts = array('Q')
+    ends = array('Q')
+    with open(file_path, 'rb') as f:
+        for record, start, end in iter_file_rows(f, file_path, lazy_columns=lazy_columns):
+            records.append(record)
+            starts.append(start)
+            ends.append(end)
+    return records, starts, ends
+
+
+def shard_bases(file_paths):
+    ## offset of each shard when the shards are seen as one file, in bytes or rows as used by their row source
+    bases = [0]
+    for file_path in file_paths[:-1]:
+        if reader_of(file_path)['seekable']:
+            bases.append(bases[-1] + parquet_row_count(file_path))
+        else:
+            bases.append(bases[-1] + os.path.getsize(file_path))
+    return bases
+
+
+def open_row_source(file_paths):
+    ## source of the note bodies of a dataset, None when they are kept in memory instead
+    ## (compressed or csv input, lazy note bodies need random access into the file)
+    if not dataset_lazy_columns(file_paths):
+        return None
+    if len(file_paths) == 1:
+        return reader_of(file_paths[0])['source'](file_paths[0])
+    return MultiRowSource(file_paths)
+
+
+class MappedRowSource:
+    ## memory-mapped view of a data file, column text is read on demand from a row byte range
+    def __init__(self, file_path, column_name='Record'):
+        self.file_path = file_path
+        self.file_paths = [file_path]
+        self.column_name = column_name
+        self.file = None
+        self.view = None  # mapped on first read
+
+    def open(self):
+        self.file = open(self.file_path, 'rb')
+        try:
+            self.view = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file can not be mapped
+            self.view = b""
+
+    def read_text(self, start, end):
+        if self.view is None:
+            self.open()
+        return self.row_text(start, end)
+
+    def close(self):
+        if isinstance(self.view, mmap.mmap):
+            self.view.close()
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.view = None
+
+    def __getstate__(self):
+        return {'file_path': self.file_path, 'file_paths': self.file_paths, 'column_name': self.column_name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.file = None
+        self.view = None
+
+
+class XmlRowSource(MappedRowSource):
+    def open(self):
+        super().open()
+        ## keep the xml declaration so that a single row is decoded with the file encoding
+        self.declaration = b""
+        if self.view[:5] == b"<?xml":
+            self.declaration = self.view[:self.view.find(b"?>") + 2]
+
+    def row_text(self, start, end_tag):
+        end = self.view.find(b">", end_tag) + 1
+        row = ET.fromstring(self.declaration + self.view[start:end])
+        for column in row.findall('COLUMN'):
+            if column.get('NAME') == self.column_name:
+                return column.text.strip() if column.text else ""
+        return ""
+
+
+class JsonlRowSource(MappedRowSource):
+    def row_text(self, start, end):
+        return column_value(json.loads(self.view[start:end]).get(self.column_name))
+
+
+class ParquetRowSource:
+    ## column of a parquet file read on demand, one row group (column chunk) at a time, start is the row number
+    def __init__(self, file_path, column_name='Record'):
+        self.file_path = file_path
+        self.file_paths = [file_path]
+        self.column_name = column_name
+        self.parquet_file = None
+        self.group_starts = []
+        self.group_index = None  # row group held in group_values
+        self.group_values = None
+
+    def read_text(self, start, end):
+        if self.parquet_file is None:
+            if pq is None:
+                raise ValueError("Reading .parquet files requires the pyarrow package (pip install pyarrow).")
+            self.parquet_file = pq.ParquetFile(self.file_path)
+            self.group_starts = [0]
+            for index in range(self.parquet_file.num_row_groups):
+                self.group_starts.append(self.group_starts[-1] + self.parquet_file.metadata.row_group(index).num_rows)
+        index = bisect.bisect_right(self.group_starts, start) - 1
+        if index != self.group_index:
+            table = self.parquet_file.read_row_group(index, columns=[self.column_name])
+            self.group_values = table.column(0).to_pylist()
+            self.group_index = index
+        return column_value(self.group_values[start - self.group_starts[index]])
+
+    def close(self):
+        if self.parquet_file is not None:
+            self.parquet_file.close()
+        self.parquet_file = None
+        self.group_index = None
+        self.group_values = None
+
+    def __getstate__(self):
+        return {'file_path': self.file_path, 'file_paths': self.file_paths, 'column_name': self.column_name}
+
+    def __setstate__(self, state):
+        self.__init__(state['file_path'], state['column_name'])
+
+
+def parquet_row_count(file_path):
+    if pq is None:
+        raise ValueError("Reading .parquet files requires the pyarrow package (pip install pyarrow).")
+    return pq.ParquetFile(file_path).metadata.num_rows
+
+
+class MultiRowSource:
+    ## several shards read as one source, offsets of a shard start at the total size of the shards before it
+    def __init__(self, file_paths, column_name='Record'):
+        self.file_paths = list(file_paths)
+        self.sources = [reader_of(file_path)['source'](file_path, column_name) for file_path in self.file_paths]
+        self.bases = shard_bases(self.file_paths)
+
+    def read_text(self, start, end_tag):
+        index = bisect.bisect_right(self.bases, start) - 1
+        base = self.bases[index]
+        return self.sources[index].read_text(start - base, end_tag - base)
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+
+## supported data file formats, keyed by extension. scan yields (record, start, end) for every row of a binary
+## file object, source reads the lazy columns back from (start, end), seekable formats are read through their
+## own reader instead of a decompressing stream. All readers give the same record dicts, see iter_file_rows.
+READERS = {
+    '.xml': {'scan': iter_xml_row_index, 'source': XmlRowSource, 'seekable': False},
+    '.jsonl': {'scan': iter_jsonl_row_index, 'source': JsonlRowSource, 'seekable': False},
+    '.csv': {'scan': iter_csv_row_index, 'source': None, 'seekable': False},
+    '.parquet': {'scan': iter_parquet_row_index, 'source': ParquetRowSource, 'seekable': True},
+}
+DATA_FILE_PATTERNS = ['*' + ext + suffix for ext in READERS if ext != '.parquet' for suffix in [''] + COMPRESSION_SUFFIXES] + ['*.parquet']
+DATA_FILE_FILTER = "Data Files (" + " ".join(DATA_FILE_PATTERNS) + ")"
@@ -0,0 +1,266 @@
+'''
+ # @ Author: Jie Yang
+ # @ Create Time: 2024.6
+ # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
+ '''
+# -*- coding: utf-8 -*-
+## text of the note view and its highlight spans, shared by the display and the background prefetch
+import re
+import sys
+import bisect
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+SPAN_CACHE_BYTES = 64 << 20  # default memory budget of the keyword spans kept per record
+RENDER_CACHE_BYTES = 64 << 20  # default memory budget of the display texts kept per record
+VIEW_PAGE_SIZE = 200  # default number of records of a page of the note view
+VIEW_WINDOW_PAGES = 3  # most pages shown at once when the note view loads pages as it is scrolled
+
+
+def format_record(records, column_names, row):
+    ## (display text, title line) of one record
+    title_text = ""
+    for name in column_names:
+        if name != 'Record':
+            title_text += name + ": " + records.value(row, name) + ", "
+    title_text = title_text.strip(", ")
+    structure_text = title_text + "\n"
+    structure_text += "Record:\n" + records.record_text(row) + "\n"
+    return structure_text, title_text
+
+
+def schema_fingerprint(column_names):
+    ## the title line of a record lists every column, the cached texts and spans of a record are kept per column set
+    ## (columns are added while a file with new fields is still loading)
+    return hashlib.blake2b('\n'.join(column_names).encode('utf-8'), digest_size=16).digest()
+
+
+def render_rows(records, column_names, rows, render_cache=None):
+    ## (view text, title lines, offset table) of the given rows. each record is formatted once, records in the
+    ## render cache not at all. the offset table has (record start, title length, body start, body length) of each
+    ## record in the view text, for the title highlight and to go to a record without searching the text
+    schema = schema_fingerprint(column_names)
+    formatted = []
+    for row in rows:
+        record = render_cache.get((row, schema)) if render_cache is not None else None
+        if record is None:
+            record = format_record(records, column_names, row)
+            if render_cache is not None:
+                render_cache.put((row, schema), record)
+        formatted.append(record)
+    offsets = []
+    position = 0
+    for structure_text, title_text in formatted:
+        body_start = position + len(title_text) + len("\nRecord:\n")
+        offsets.append((position, len(title_text), body_start, position + len(structure_text) - 1 - body_start))
+        position += len(structure_text) + 1
+    return "\n".join(structure_text for structure_text, title_text in formatted), [title_text for structure_text, title_text in formatted], offsets
+
+
+class KeywordMatcher:
+    ## all the keywords of a set compiled into one pattern, built once when the keywords change. the keywords are
+    ## merged into a trie and the trie is written as nested alternatives, so the scan is a single pass over the
+    ## text that follows at most one trie branch from each position, whatever the number of keywords
+    def __init__(self, keywords, whole_word=False):
+        self.keywords = frozenset(keyword for keyword in keywords if keyword)
+        self.whole_word = whole_word  # only matches that start and end at word boundaries
+        trie = {}
+        for keyword in self.keywords:
+            node = trie
+            for character in keyword:
+                node = node.setdefault(character, {})
+            node[''] = True  # a keyword ends here
+        pattern = trie_pattern(trie)
+        if whole_word:
+            pattern = r'(?<!\w)(?:' + pattern + r')(?!\w)'
+        self.pattern = re.compile(pattern) if self.keywords else None
+        ## identifies the keyword set (with the power highlight keywords when they are on) and the match mode
+        self.fingerprint = hashlib.blake2b(('\n'.join(sorted(self.keywords)) + '\n' + str(whole_word)).encode('utf-8'), digest_size=16).digest()
+
+    def spans(self, text):
+        ## (start, length) of the keyword occurrences of the text, case-insensitive. where occurrences overlap
+        ## the leftmost wins, and of those starting together the longest
+        if self.pattern is None:
+            return []
+        return [(match.start(), match.end() - match.start()) for match in self.pattern.finditer(text.lower())]
+
+    def search(self, text):
+        ## True if a keyword occurs in the text, stops at the first occurrence
+        return self.pattern is not None and self.pattern.search(text.lower()) is not None
+
+
+def trie_pattern(node):
+    ## pattern of a trie node: one alternative per child, chains without branches are written as one literal,
+    ## greedy optional groups where a keyword ends make the longest keyword match first
+    alternatives = []
+    for character in sorted(character for character in node if character):
+        literal = character
+        child = node[character]
+        while len(child) == 1 and '' not in child:
+            (character, child), = child.items()
+            literal += character
+        alternatives.append(re.escape(literal) + trie_pattern(child))
+    if not alternatives:
+        return ''
+    pattern = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+    return '(?:' + pattern + ')?' if '' in node else pattern
+
+
+keyword_matchers = {}  # (keywords, whole_word) -> KeywordMatcher, the keyword sets in use
+keyword_matchers_lock = threading.Lock()  # the display and the workers share the matchers
+
+
+def keyword_matcher(keywords, whole_word=False):
+    ## the matcher of the keyword set, only built when the set was not seen recently
+    key = (frozenset(keyword for keyword in keywords if keyword), whole_word)
+    with keyword_matchers_lock:
+        matcher = keyword_matchers.get(key)
+        if matcher is None:
+            if len(keyword_matchers) >= 8:
+                keyword_matchers.pop(next(iter(keyword_matchers)))
+            matcher = KeywordMatcher(key[0], whole_word)
+            keyword_matchers[key] = matcher
+    return matcher
+
+
+def keyword_spans(text, keywords, whole_word=False):
+    ## (start, length) of the case-insensitive occurrences of the keywords, the longest wins where they overlap
+    return keyword_matcher(keywords, whole_word).spans(text)
+
+
+class LRUCache:
+    ## values kept within a memory budget, the least recently used are dropped beyond max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0  # estimated bytes of the entries
+        self.lock = threading.Lock()  # the display and the workers share the cache
+
+    def entry_size(self, key, value):
+        return sys.getsizeof(value) + sys.getsizeof(key) + 64
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.size -= self.entry_size(key, old_value)
+            self.entries[key] = value
+            self.size += self.entry_size(key, value)
+            while self.size > self.max_bytes and self.entries:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.size -= self.entry_size(old_key, old_value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SpanCache(LRUCache):
+    ## keyword spans of the display text of each record, per keyword set and schema fingerprint, so that a record
+    ## shown again for the same keywords and columns is not searched again. spans are kept as an array of start,
+    ## length, start, length...
+    def __init__(self, max_bytes=SPAN_CACHE_BYTES):
+        super().__init__(max_bytes)
+
+    def get(self, row, fingerprint, schema):
+        values = super().get((row, fingerprint, schema))
+        if values is None:
+            return None
+        return list(zip(values[0::2], values[1::2]))
+
+    def put(self, row, fingerprint, schema, spans):
+        super().put((row, fingerprint, schema), array('I', [value for span in spans for value in span]))
+
+
+class RenderCache(LRUCache):
+    ## (display text, title line) of each record, so that a record shown again is not read and formatted again
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        super().__init__(max_bytes)
+
+    def entry_size(self, key, value):
+        return sys.getsizeof(value[0]) + sys.getsizeof(value[1]) + sys.getsizeof(key) + 64
+
+
+def record_keyword_spans(view, matcher, span_cache=None, search=True, interrupted=None):
+    ## keyword spans of a view, put together from the spans of its records. records in the span cache are not
+    ## searched; without search the spans are only returned if every record is in the cache, None otherwise.
+    ## None as well when interrupted() turns true
+    text = view['text']
+    record_starts = view['record_starts']
+    spans = []
+    for index, row in enumerate(view['rows']):
+        if interrupted is not None and interrupted():
+            return None
+        record_spans = span_cache.get(row, matcher.fingerprint, view['schema']) if span_cache is not None else None
+        if record_spans is None:
+            if not search:
+                return None
+            end = record_starts[index + 1] - 1 if index + 1 < len(record_starts) else len(text)
+            record_spans = matcher.spans(text[record_starts[index]:end])
+            if span_cache is not None:
+                span_cache.put(row, matcher.fingerprint, view['schema'], record_spans)
+        start = record_starts[index]
+        spans += [(start + index_in_record, length) for index_in_record, length in record_spans]
+    return spans
+
+
+def changed_keyword_spans(view, matcher, previous, span_cache=None, interrupted=None):
+    ## keyword spans of a view from its spans for another keyword set with the same match mode, previous is
+    ## (keywords, spans). only the added and removed keywords are searched: a record in which none of them occurs
+    ## keeps its previous spans, the others are matched again as a whole, since a changed keyword can shadow or
+    ## uncover the matches of the kept keywords around it. None when interrupted() turns true
+    text = view['text']
+    record_starts = view['record_starts']
+    previous_keywords = frozenset(keyword for keyword in previous[0] if keyword)
+    changed_matcher = keyword_matcher(previous_keywords ^ matcher.keywords, matcher.whole_word)
+    previous_spans = previous[1]
+    previous_starts = [start for start, length in previous_spans]
+    spans = []
+    position = 0  # previous spans before this index are in spans already
+    for index, row in enumerate(view['rows']):
+        if interrupted is not None and interrupted():
+            return None
+        start = record_starts[index]
+        end = record_starts[index + 1] - 1 if index + 1 < len(record_starts) else len(text)
+        record_text = text[start:end]
+        if not changed_matcher.search(record_text):
+            continue
+        first = bisect.bisect_left(previous_starts, start, position)
+        spans += previous_spans[position:first]
+        position = bisect.bisect_left(previous_starts, end, first)
+        record_spans = span_cache.get(row, matcher.fingerprint, view['schema']) if span_cache is not None else None
+        if record_spans is None:
+            record_spans = matcher.spans(record_text)
+            if span_cache is not None:
+                span_cache.put(row, matcher.fingerprint, view['schema'], record_spans)
+        spans += [(start + index_in_record, length) for index_in_record, length in record_spans]
+    spans += previous_spans[position:]
+    return spans
+
+
+def render_view(records, column_names, rows, keywords=None, whole_word=False, span_cache=None, render_cache=None):
+    ## everything update_display needs to show the rows: text, title lines, offset table and highlight spans.
+    ## the title spans come from the offset table, without keywords the keyword spans are left to be computed
+    ## when they are highlighted
+    text, titles, offsets = render_rows(records, column_names, rows, render_cache)
+    view = {'rows': list(rows), 'schema': schema_fingerprint(column_names), 'text': text, 'titles': titles, 'offsets': offsets,
+            'record_starts': [record_start for record_start, title_length, body_start, body_length in offsets],
+            'title_spans': [(record_start, title_length) for record_start, title_length, body_start, body_length in offsets],
+            'keywords': None, 'whole_word': whole_word, 'keyword_spans': None}
+    if keywords is not None:
+        view['keywords'] = frozenset(keywords)
+        view['keyword_spans'] = record_keyword_spans(view, keyword_matcher(keywords, whole_word), span_cache)
+    return view
@@ -0,0 +1,174 @@
+'''
+ # @ Author: Jie Yang
+ # @ Create Time: 2024.6
+ # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
+ '''
+# -*- coding: utf-8 -*-
+## full-text search over the note bodies of a dataset
+import os
+import re
+import math
+import pickle
+import bisect
+from array import array
+
+TOKEN_PATTERN = re.compile(r'\w+')
+SEARCH_VERSION = 1  # bump when the pickled SearchIndex layout changes
+
+
+def tokenize(text):
+    ## lower-cased word tokens of a text, token positions in the index are positions in this list
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_query(query):
+    ## query text -> list of phrases (term lists). A double-quoted text is one phrase, so is every other
+    ## space separated word, a word with punctuation like "covid-19" matches its tokens next to each other
+    phrases = []
+    for quoted, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        terms = tokenize(quoted or word)
+        if terms:
+            phrases.append(terms)
+    return phrases
+
+
+class SearchIndex:
+    ## positional inverted index of the Record column. Every term has a posting list of the rows it occurs
+    ## in and the token positions in each row: rows[i] has the positions positions[ends[i - 1]:ends[i]].
+    ## rows are indexed in load order, so rows appended to the dataset are added at the end.
+    def __init__(self):
+        self.postings = {}  # term -> (rows, ends, positions)
+        self.row_lengths = array('I')  # token count of each row
+        self.row_patients = array('I')  # PatientID code of each row
+        self.patient_ids = []  # code -> PatientID
+        self.patient_codes = {}  # PatientID -> code
+        self.total_length = 0
+        self.row_count = 0
+        self.fingerprint = None  # fingerprint of the dataset when it was indexed
+
+    def __len__(self):
+        return self.row_count
+
+    def add(self, text, patient_id):
+        row = self.row_count
+        term_positions = {}
+        tokens = tokenize(text)
+        for position, term in enumerate(tokens):
+            positions = term_positions.get(term)
+            if positions is None:
+                term_positions[term] = [position]
+            else:
+                positions.append(position)
+        for term, positions in term_positions.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array('I'), array('I'), array('I'))
+            posting[0].append(row)
+            posting[2].extend(positions)
+            posting[1].append(len(posting[2]))
+        code = self.patient_codes.get(patient_id)
+        if code is None:
+            code = self.patient_codes[patient_id] = len(self.patient_ids)
+            self.patient_ids.append(patient_id)
+        self.row_patients.append(code)
+        self.row_lengths.append(len(tokens))
+        self.total_length += len(tokens)
+        self.row_count += 1
+
+    def row_positions(self, posting, index):
+        start = posting[1][index - 1] if index > 0 else 0
+        return posting[2][start:posting[1][index]]
+
+    def phrase_counts(self, terms):
+        ## row -> number of occurrences of the phrase, candidate rows come from its rarest term
+        postings = [self.postings.get(term) for term in terms]
+        if any(posting is None for posting in postings):
+            return {}
+        if len(terms) == 1:
+            rows, ends = postings[0][0], postings[0][1]
+            return {row: ends[i] - (ends[i - 1] if i > 0 else 0) for i, row in enumerate(rows)}
+        rarest = min(range(len(terms)), key=lambda k: len(postings[k][0]))
+        counts = {}
+        for i, row in enumerate(postings[rarest][0]):
+            ## positions of every term in this row, relative to the start of the phrase
+            offsets = None
+            for k, posting in enumerate(postings):
+                index = bisect.bisect_left(posting[0], row)
+                if index == len(posting[0]) or posting[0][index] != row:
+                    offsets = None
+                    break
+                starts = {position - k for position in self.row_positions(posting, index)}
+                offsets = starts if offsets is None else offsets & starts
+                if not offsets:
+                    break
+            if offsets:
+                counts[row] = len(offsets)
+        return counts
+
+    def search(self, query, k1=1.2, b=0.75):
+        ## rows with every phrase of the query, ranked by BM25 -> (records, patients).
+        ## records: [(score, row)] best first, patients: [(score, PatientID, [(score, row)])] best first,
+        ## a patient scores the sum of its records
+        phrases = parse_query(query)
+        if not phrases or self.row_count == 0:
+            return [], []
+        average_length = self.total_length / self.row_count or 1
+        scores = None
+        for terms in sorted(phrases, key=lambda terms: min(len(self.postings.get(term, ((),))[0]) for term in terms)):
+            counts = self.phrase_counts(terms)
+            if scores is not None:
+                counts = {row: count for row, count in counts.items() if row in scores}
+            idf = math.log(1 + (self.row_count - len(counts) + 0.5) / (len(counts) + 0.5))
+            phrase_scores = {}
+            for row, count in counts.items():
+                norm = k1 * (1 - b + b * self.row_lengths[row] / average_length)
+                phrase_scores[row] = (scores[row] if scores is not None else 0) + idf * count * (k1 + 1) / (count + norm)
+            scores = phrase_scores
+            if not scores:
+                return [], []
+        records = sorted(((score, row) for row, score in scores.items()), reverse=True)
+        patients = {}
+        for score, row in records:
+            patients.setdefault(self.row_patients[row], []).append((score, row))
+        patients = sorted(((sum(score for score, row in hits), self.patient_ids[code], hits) for code, hits in patients.items()),
+                          key=lambda patient: patient[0], reverse=True)
+        return records, patients
+
+
+def match_spans(text, query):
+    ## (start, length) of every query term in a displayed text, for highlighting the hits of a search
+    terms = {term for terms in parse_query(query) for term in terms}
+    return [(match.start(), match.end() - match.start()) for match in TOKEN_PATTERN.finditer(text)
+            if match.group().lower() in terms]
+
+
+## search index cache, a binary sidecar file next to the dataset
+def search_index_path(file_path):
+    return os.path.splitext(file_path)[0] + '_cora_search.pkl'
+
+
+def save_search_index(index, file_path):
+    path = search_index_path(file_path)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'version': SEARCH_VERSION, 'fingerprint': index.fingerprint}, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print("Failed to write search index:", e)
+
+
+def load_search_index(file_path, fingerprint):
+    ## the saved index of file_path, or None if there is none or it was built for another version of the dataset
+    path = search_index_path(file_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('version') != SEARCH_VERSION or header.get('fingerprint') != fingerprint:
+                return None
+            return pickle.load(f)
+    except Exception as e:
+        print("Failed to read search index:", e)
+        return None
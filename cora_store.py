@@ -0,0 +1,757 @@
+'''
+ # @ Author: Jie Yang
+ # @ Create Time: 2024.6
+ # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
+ '''
+# -*- coding: utf-8 -*-
+## compact record storage shared by the CORA annotation tools
+import os
+import json
+import copy
+import pickle
+import sqlite3
+import heapq
+import bisect
+import hashlib
+import calendar
+import pathlib
+from array import array
+from datetime import datetime, timedelta
+
+PATIENT_ID = 'PatientID'
+RECORD_ID = 'RecordID'
+RECORD_TYPE = 'Record_Type'
+RECORD_DATE = 'Record_Date'
+RECORD_TEXT = 'Record'
+
+## Record_Date layouts that can be stored as integers and printed back unchanged
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%Y-%m-%d %H:%M', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y', '%Y%m%d']
+RAW_DATE = 255  # date format code of a Record_Date kept as text
+NO_DATE = -2 ** 63  # date value of a Record_Date that is empty or not parsable
+EPOCH = datetime(1970, 1, 1)
+CACHE_VERSION = 6  # bump when the pickled RecordStore layout changes
+
+
+def parse_date(text):
+    ## Record_Date text -> (seconds since 1970, format code), (NO_DATE, RAW_DATE) if not parsable
+    if len(text) == 19 and text[4] + text[7] + text[10] + text[13] + text[16] == '-- ::':
+        ## fast path for the usual 'yyyy-mm-dd hh:mm:ss', strptime is slow
+        try:
+            date = datetime(int(text[:4]), int(text[5:7]), int(text[8:10]), int(text[11:13]), int(text[14:16]), int(text[17:]))
+            if date.strftime(DATE_FORMATS[0]) == text:
+                return calendar.timegm(date.timetuple()), 0
+        except ValueError:
+            pass
+    for code, date_format in enumerate(DATE_FORMATS):
+        try:
+            date = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        if date.strftime(date_format) == text:
+            return calendar.timegm(date.timetuple()), code
+    return NO_DATE, RAW_DATE
+
+
+def cached_parse_date(cache, text):
+    parsed = cache.get(text)
+    if parsed is None:
+        parsed = parse_date(text)
+        if len(cache) > 100000:
+            cache.clear()
+        cache[text] = parsed
+    return parsed
+
+
+def format_date(value, code):
+    return (EPOCH + timedelta(seconds=value)).strftime(DATE_FORMATS[code])
+
+
+class CategoricalColumn:
+    ## a text column stored as integer codes into a table of interned values.
+    ## an indexed column also keeps a posting list per value: the rows holding it, in load order.
+    ## A value of a single row (e.g. most RecordIDs) keeps the row number instead of an array.
+    def __init__(self, indexed=False):
+        self.codes = array('I')
+        self.categories = []
+        self.category_codes = {}
+        self.postings = [] if indexed else None
+
+    def encode(self, value):
+        code = self.category_codes.get(value)
+        if code is None:
+            code = len(self.categories)
+            self.categories.append(value)
+            self.category_codes[value] = code
+            if self.postings is not None:
+                self.postings.append(None)
+        return code
+
+    def append(self, value):
+        code = self.encode(value)
+        if self.postings is not None:
+            self.add_posting(code, len(self.codes))
+        self.codes.append(code)
+
+    def add_posting(self, code, row):
+        posting = self.postings[code]
+        if posting is None:
+            self.postings[code] = row
+        elif isinstance(posting, int):
+            self.postings[code] = array('I', [posting, row])
+        else:
+            posting.append(row)
+
+    def extend_blank(self, count):
+        ## back fill rows loaded before this column first appeared
+        if count:
+            code = self.encode('')
+            if self.postings is not None:
+                for row in range(count):
+                    self.add_posting(code, row)
+            self.codes.extend(array('I', [code]) * count)
+
+    def rows(self, value):
+        ## posting list of a value, rows in load order
+        code = self.category_codes.get(value)
+        if code is None or self.postings is None:
+            return []
+        posting = self.postings[code]
+        if isinstance(posting, int):
+            return [posting]
+        return posting
+
+    def __getitem__(self, row):
+        return self.categories[self.codes[row]]
+
+    def __getstate__(self):
+        return {'codes': self.codes, 'categories': self.categories, 'postings': self.postings}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.category_codes = {value: code for code, value in enumerate(self.categories)}
+
+
+class RecordStore:
+    ## columnar record store: ids and types as interned codes, dates as integers,
+    ## note bodies in one utf-8 buffer with offsets. Rows are addressed by their load order.
+    ## with a source (cora_reader.XmlRowSource) note bodies are not kept, only the byte range
+    ## of each row, and the body is read from the source when it is displayed.
+    def __init__(self, source=None):
+        self.column_names = []  # column names in file order
+        ## the droplist columns are indexed, filters are answered from their posting lists
+        self.columns = {PATIENT_ID: CategoricalColumn(True), RECORD_ID: CategoricalColumn(True), RECORD_TYPE: CategoricalColumn(True)}
+        self.dates = array('q')  # Record_Date as seconds since 1970
+        self.date_codes = array('B')  # index into DATE_FORMATS
+        self.raw_dates = {}  # row -> Record_Date text that does not fit DATE_FORMATS
+        self.date_cache = {}  # Record_Date text -> (value, code), many notes share a date
+        self.text_buffer = bytearray()
+        self.text_offsets = array('Q', [0])
+        self.source = source
+        self.row_starts = array('Q')  # byte offset of each ROW in the source
+        self.row_ends = array('Q')  # byte offset of the closing tag of each ROW
+        self.fingerprint = None  # file_fingerprint of the source file when it was read
+        self.last_row_span = None  # span of the last appended row, appended rows of the file are read from there
+        self.date_sorted = {}  # (column, value) -> (rows seen, rows of its posting list in Record_Date order, their dates)
+        ## patient summary table, indexed by PatientID code and kept up to date on append:
+        ## record count and the rows of the first and last Record_Date of each patient
+        self.patient_record_counts = array('I')
+        self.patient_first_rows = array('I')
+        self.patient_last_rows = array('I')
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['date_cache'] = {}
+        state['date_sorted'] = {}
+        return state
+
+    def add_column(self, name):
+        self.column_names.append(name)
+        if name not in (RECORD_DATE, RECORD_TEXT) and name not in self.columns:
+            column = CategoricalColumn()
+            column.extend_blank(self.size)
+            self.columns[name] = column
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+
+    def reader(self):
+        ## copy of the store for reading the loaded rows from another thread, with its own handle on the source
+        reader = copy.copy(self)
+        if self.source is not None:
+            reader.source = pickle.loads(pickle.dumps(self.source))
+        return reader
+
+    def append(self, record, span=None):
+        for name in record:
+            if name not in self.column_names:
+                self.add_column(name)
+        for name, column in self.columns.items():
+            column.append(record.get(name, ''))
+        self.append_date(record.get(RECORD_DATE, ''))
+        if self.source is None:
+            self.text_buffer += record.get(RECORD_TEXT, '').encode('utf-8')
+            self.text_offsets.append(len(self.text_buffer))
+        else:
+            self.row_starts.append(span[0])
+            self.row_ends.append(span[1])
+        if span is not None:
+            self.last_row_span = span
+        self.update_patient_summary(self.size)
+        self.size += 1
+
+    def extend(self, records, spans=None):
+        ## append record dicts (and their byte ranges in the source), returns the range of the new rows
+        start = self.size
+        if spans is None:
+            for record in records:
+                self.append(record)
+        else:
+            for record, span in zip(records, spans):
+                self.append(record, span)
+        return range(start, self.size)
+
+    def append_date(self, text):
+        value, code = cached_parse_date(self.date_cache, text)
+        if code == RAW_DATE and text:
+            self.raw_dates[self.size] = text
+        self.dates.append(value)
+        self.date_codes.append(code)
+
+    def update_patient_summary(self, row):
+        code = self.columns[PATIENT_ID].codes[row]
+        if code == len(self.patient_record_counts):  # first record of a new patient
+            self.patient_record_counts.append(1)
+            self.patient_first_rows.append(row)
+            self.patient_last_rows.append(row)
+            return
+        self.patient_record_counts[code] += 1
+        value = self.dates[row]
+        if value == NO_DATE:
+            return  # dates are compared as numbers, rows without a date do not count
+        first_value = self.dates[self.patient_first_rows[code]]
+        if first_value == NO_DATE or value < first_value:
+            self.patient_first_rows[code] = row
+        last_value = self.dates[self.patient_last_rows[code]]
+        if last_value == NO_DATE or value > last_value:
+            self.patient_last_rows[code] = row
+
+    def last_span(self):
+        return self.last_row_span
+
+    ## accessors, all consumers read the records through these
+    def patient_id(self, row):
+        return self.columns[PATIENT_ID][row]
+
+    def record_id(self, row):
+        return self.columns[RECORD_ID][row]
+
+    def record_type(self, row):
+        return self.columns[RECORD_TYPE][row]
+
+    def record_date(self, row):
+        code = self.date_codes[row]
+        if code == RAW_DATE:
+            return self.raw_dates.get(row, '')
+        return format_date(self.dates[row], code)
+
+    def date_value(self, row):
+        return self.dates[row]
+
+    def record_text(self, row):
+        if self.source is not None:
+            return self.source.read_text(self.row_starts[row], self.row_ends[row])
+        return self.text_buffer[self.text_offsets[row]:self.text_offsets[row + 1]].decode('utf-8')
+
+    def value(self, row, name):
+        if name == RECORD_TEXT:
+            return self.record_text(row)
+        if name == RECORD_DATE:
+            return self.record_date(row)
+        column = self.columns.get(name)
+        return column[row] if column is not None else ''
+
+    def record(self, row):
+        return {name: self.value(row, name) for name in self.column_names}
+
+    def distinct(self, name, rows=None):
+        ## distinct values of a metadata column, over all rows or the given ones
+        column = self.columns[name]
+        if rows is None or len(rows) == self.size:
+            return set(column.categories)  # every interned value is used by at least one row
+        return set(column.categories[column.codes[row]] for row in rows)
+
+    def patient_count(self):
+        return len(self.columns[PATIENT_ID].categories)
+
+    def select(self, patient_id="All", record_type="All", record_id="All", start_date=None, end_date=None):
+        ## rows matching the droplist selection, "All" matches everything.
+        ## starts from the shortest posting list and checks the other filters on its rows only,
+        ## so the cost follows the selected patient (or record) instead of the whole dataset
+        if start_date is not None or end_date is not None:
+            ## date filter, binary search in the date index of the patient or record type
+            rows = self.date_window(patient_id, record_type, start_date, end_date)
+            if record_id != "All":
+                codes = self.columns[RECORD_ID].codes
+                code = self.columns[RECORD_ID].category_codes.get(record_id)
+                rows = [row for row in rows if codes[row] == code]
+            return sorted(rows)
+        filters = [(name, value) for name, value in ((PATIENT_ID, patient_id), (RECORD_TYPE, record_type), (RECORD_ID, record_id)) if value != "All"]
+        if not filters:
+            return list(range(self.size))
+        postings = sorted(((self.columns[name].rows(value), name, value) for name, value in filters), key=lambda posting: len(posting[0]))
+        rows, _, _ = postings[0]
+        for _, name, value in postings[1:]:
+            codes = self.columns[name].codes
+            code = self.columns[name].category_codes.get(value)
+            rows = [row for row in rows if codes[row] == code]
+        return list(rows)
+
+    def date_key(self, row):
+        return (self.dates[row], row)
+
+    def date_index(self, name=None, value=None):
+        ## rows of a posting list (all rows when name is None) in Record_Date order and their dates, for binary search.
+        ## Kept per value, only the rows appended since the last call are sorted and merged in
+        posting = range(self.size) if name is None else self.columns[name].rows(value)
+        count, rows, dates = self.date_sorted.get((name, value), (0, [], array('q')))
+        if count < len(posting):
+            new_rows = sorted(posting[count:], key=self.date_key)
+            if rows and self.date_key(new_rows[0]) < self.date_key(rows[-1]):
+                rows = list(heapq.merge(rows, new_rows, key=self.date_key))
+                dates = array('q', (self.dates[row] for row in rows))
+            else:
+                rows = rows + new_rows
+                dates = dates + array('q', (self.dates[row] for row in new_rows))
+            self.date_sorted[(name, value)] = (len(posting), rows, dates)
+        return rows, dates
+
+    def selection_index(self, patient_id="All", record_type="All"):
+        ## date index searched for a selection: of the patient if one is selected, else of the record type, else of all rows
+        if patient_id != "All":
+            return self.date_index(PATIENT_ID, patient_id)
+        if record_type != "All":
+            return self.date_index(RECORD_TYPE, record_type)
+        return self.date_index()
+
+    def date_window(self, patient_id="All", record_type="All", start_date=None, end_date=None):
+        ## rows of a patient and/or record type in Record_Date order, with Record_Date between start_date and
+        ## end_date (seconds since 1970, inclusive) when given. Rows without a date are left out of a window
+        rows, dates = self.selection_index(patient_id, record_type)
+        if start_date is not None or end_date is not None:
+            low = bisect.bisect_right(dates, NO_DATE) if start_date is None else bisect.bisect_left(dates, start_date)
+            high = len(dates) if end_date is None else bisect.bisect_right(dates, end_date)
+            rows = rows[low:high]
+        if patient_id != "All" and record_type != "All":
+            codes = self.columns[RECORD_TYPE].codes
+            code = self.columns[RECORD_TYPE].category_codes.get(record_type)
+            rows = [row for row in rows if codes[row] == code]
+        return rows
+
+    def next_date(self, patient_id="All", record_type="All", value=0, direction=1):
+        ## first Record_Date after value (direction 1) or last one before it (direction -1), None if there is none
+        if patient_id != "All" and record_type != "All":
+            dates = [self.dates[row] for row in self.date_window(patient_id, record_type)]
+        else:
+            dates = self.selection_index(patient_id, record_type)[1]
+        if direction > 0:
+            index = bisect.bisect_right(dates, value)
+            return dates[index] if index < len(dates) else None
+        index = bisect.bisect_left(dates, value) - 1
+        return dates[index] if index >= 0 and dates[index] != NO_DATE else None
+
+    def record_ids(self, patient_id="All", record_type="All", start_date=None, end_date=None):
+        ## RecordIDs for the record droplist, of a patient and/or a record type, in Record_Date order
+        record_id_column = self.columns[RECORD_ID]
+        return list(dict.fromkeys(record_id_column[row] for row in self.date_window(patient_id, record_type, start_date, end_date)))
+
+    def patient_summaries(self, rows=None):
+        ## record count, first and last Record_Date of every patient with records in the given rows (all patients
+        ## by default), read from the summary table, so they always cover all the records of a patient
+        ## patients in the order of their first record, the codes are interned in that order
+        column = self.columns[PATIENT_ID]
+        if rows is None or len(rows) == self.size:
+            codes = range(len(column.categories))
+        else:
+            present = set(column.codes[row] for row in rows)
+            codes = [code for code in range(len(column.categories)) if code in present]
+        summaries = {}
+        for code in codes:
+            patient_id = column.categories[code]
+            summaries[patient_id] = {'record_count': self.patient_record_counts[code],
+                                     'start_date': self.record_date(self.patient_first_rows[code]),
+                                     'end_date': self.record_date(self.patient_last_rows[code])}
+        return summaries
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def is_cora_database(db_path):
+    ## True if db_path is a database written by CORA. checked on a read-only connection, so that any other
+    ## database picked by mistake is left as it is
+    try:
+        connection = sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + '?mode=ro', uri=True)
+        try:
+            tables = set(name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+            if not {'meta', 'records'} <= tables:
+                return False
+            columns = set(row[1] for row in connection.execute('PRAGMA table_info(records)'))
+            if not {'_row', '_date', '_start', '_end'} <= columns:
+                return False
+            return connection.execute("SELECT 1 FROM meta WHERE key = 'column_names'").fetchone() is not None
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+
+
+class SqliteRecordStore:
+    ## record store kept in a local SQLite database with indexes on the filter columns, so the dataset
+    ## does not need to fit in memory. Same accessor API as RecordStore, filters run as indexed queries.
+    ## table records holds one row per record: _row (load order), _date (Record_Date as seconds since 1970),
+    ## _start/_end (byte range of the ROW when note bodies are read from a source) and one TEXT column per
+    ## CORA column. Note bodies are stored in the Record column when there is no source.
+    ## only a store created by CORA (create=True, e.g. by create_store) gets the schema, any other database has to
+    ## be a CORA database already, a ValueError is raised otherwise before anything is written to it
+    def __init__(self, db_path, source=None, create=False):
+        self.db_path = db_path
+        self.source = source
+        self.fingerprint = None
+        self.connect(create)
+
+    def connect(self, create=False):
+        if not create and not is_cora_database(self.db_path):
+            raise ValueError(f"{self.db_path} is not a CORA database")
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        if create:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('column_names', '[]')")
+            self.connection.execute('CREATE TABLE IF NOT EXISTS records (_row INTEGER PRIMARY KEY, _date INTEGER, _start INTEGER, _end INTEGER, '
+                                    'PatientID TEXT, RecordID TEXT, Record_Type TEXT, Record_Date TEXT)')
+            for name in (RECORD_ID, '_date'):
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {quote("records_" + name)} ON records ({quote(name)})')
+            ## patient and record type lists are read in Record_Date order straight from these
+            for name in (PATIENT_ID, RECORD_TYPE):
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {quote("records_" + name + "_date")} ON records ({quote(name)}, _date)')
+        ## patient summary table, kept up to date on insert. first/last_date are NULL while a patient has no dated record
+        if not self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'patients'").fetchone():
+            self.connection.execute('CREATE TABLE patients (PatientID TEXT PRIMARY KEY, record_count INTEGER, '
+                                    'first_date INTEGER, last_date INTEGER, start_date TEXT, end_date TEXT)')
+            self.update_patient_summaries('SELECT PatientID, _date, Record_Date FROM records ORDER BY _row')
+        self.connection.commit()
+        self.column_names = json.loads(self.get_meta('column_names', '[]'))
+        self.table_columns = [row[1] for row in self.connection.execute('PRAGMA table_info(records)')]
+        if self.source is None and RECORD_TEXT not in self.table_columns and self.get_meta('source_paths'):
+            ## sidecar database of xml files, note bodies are still in the xml
+            from cora_reader import open_row_source
+            self.source = open_row_source(json.loads(self.get_meta('source_paths')))
+        self.size = self.connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+        self.date_cache = {}
+        self.row_cache = {}
+        self.patient_total = None
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        return {'db_path': self.db_path, 'source': self.source, 'fingerprint': self.fingerprint}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.connect()
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+        if self.source is not None:
+            self.source.close()
+
+    def reader(self):
+        ## store on its own connection for reading the loaded rows from another thread, call it in that thread
+        return SqliteRecordStore(self.db_path, None if self.source is None else pickle.loads(pickle.dumps(self.source)))
+
+    def add_column(self, name):
+        self.column_names.append(name)
+        self.set_meta('column_names', json.dumps(self.column_names))
+        if name == RECORD_TEXT and self.source is not None:
+            return
+        if name not in self.table_columns:
+            self.connection.execute(f'ALTER TABLE records ADD COLUMN {quote(name)} TEXT')
+            self.table_columns.append(name)
+
+    def append(self, record, span=None):
+        self.extend([record], None if span is None else [span])
+
+    def extend(self, records, spans=None):
+        ## append record dicts (and their byte ranges in the source), returns the range of the new rows
+        start = self.size
+        for record in records:
+            for name in record:
+                if name not in self.column_names:
+                    self.add_column(name)
+        if self.source is not None and not self.get_meta('source_paths'):
+            self.set_meta('source_paths', json.dumps(self.source.file_paths))
+        columns = [name for name in self.table_columns if not name.startswith('_')]
+        sql = (f'INSERT INTO records (_row, _date, _start, _end, {", ".join(quote(name) for name in columns)}) '
+               f'VALUES ({", ".join("?" * (len(columns) + 4))})')
+        values = []
+        for i, record in enumerate(records):
+            row_start, row_end = spans[i] if spans is not None else (0, 0)
+            date_value = cached_parse_date(self.date_cache, record.get(RECORD_DATE, ''))[0]
+            values.append((start + i, date_value, row_start, row_end) + tuple(record.get(name, '') for name in columns))
+        self.connection.executemany(sql, values)
+        self.update_patient_summaries('SELECT PatientID, _date, Record_Date FROM records WHERE _row >= ? ORDER BY _row', (start,))
+        self.connection.commit()
+        self.size += len(records)
+        self.patient_total = None
+        return range(start, self.size)
+
+    def update_patient_summaries(self, sql, params=()):
+        ## add the rows returned by sql (PatientID, _date, Record_Date) to the patient summary table
+        summaries = {}
+        for patient_id, date_value, record_date in self.connection.execute(sql, params):
+            summary = summaries.setdefault(patient_id or '', [0, None, None, '', ''])
+            if summary[0] == 0:
+                summary[3] = summary[4] = record_date or ''
+            summary[0] += 1
+            if date_value == NO_DATE:
+                continue
+            if summary[1] is None or date_value < summary[1]:
+                summary[1], summary[3] = date_value, record_date
+            if summary[2] is None or date_value > summary[2]:
+                summary[2], summary[4] = date_value, record_date
+        self.connection.executemany(
+            'INSERT INTO patients (PatientID, record_count, first_date, last_date, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(PatientID) DO UPDATE SET record_count = record_count + excluded.record_count, '
+            'start_date = CASE WHEN excluded.first_date IS NOT NULL AND (first_date IS NULL OR excluded.first_date < first_date) THEN excluded.start_date ELSE start_date END, '
+            'first_date = CASE WHEN excluded.first_date IS NOT NULL AND (first_date IS NULL OR excluded.first_date < first_date) THEN excluded.first_date ELSE first_date END, '
+            'end_date = CASE WHEN excluded.last_date IS NOT NULL AND (last_date IS NULL OR excluded.last_date > last_date) THEN excluded.end_date ELSE end_date END, '
+            'last_date = CASE WHEN excluded.last_date IS NOT NULL AND (last_date IS NULL OR excluded.last_date > last_date) THEN excluded.last_date ELSE last_date END',
+            [(patient_id,) + tuple(summary) for patient_id, summary in summaries.items()])
+
+    def fetch(self, row):
+        ## metadata of one row as a dict, recently used rows are kept in memory
+        values = self.row_cache.get(row)
+        if values is None:
+            columns = [name for name in self.table_columns if name != RECORD_TEXT]
+            cursor = self.connection.execute(f'SELECT {", ".join(quote(name) for name in columns)} FROM records WHERE _row = ?', (row,))
+            values = dict(zip(columns, cursor.fetchone()))
+            if len(self.row_cache) > 4096:
+                self.row_cache.clear()
+            self.row_cache[row] = values
+        return values
+
+    def last_span(self):
+        if self.size == 0:
+            return None
+        return tuple(self.connection.execute('SELECT _start, _end FROM records WHERE _row = ?', (self.size - 1,)).fetchone())
+
+    ## accessors, all consumers read the records through these
+    def patient_id(self, row):
+        return self.fetch(row)[PATIENT_ID] or ''
+
+    def record_id(self, row):
+        return self.fetch(row)[RECORD_ID] or ''
+
+    def record_type(self, row):
+        return self.fetch(row)[RECORD_TYPE] or ''
+
+    def record_date(self, row):
+        return self.fetch(row)[RECORD_DATE] or ''
+
+    def date_value(self, row):
+        return self.fetch(row)['_date']
+
+    def record_text(self, row):
+        if self.source is not None:
+            values = self.fetch(row)
+            return self.source.read_text(values['_start'], values['_end'])
+        if RECORD_TEXT not in self.table_columns:
+            return ''
+        return self.connection.execute('SELECT Record FROM records WHERE _row = ?', (row,)).fetchone()[0] or ''
+
+    def value(self, row, name):
+        if name == RECORD_TEXT:
+            return self.record_text(row)
+        return self.fetch(row).get(name) or ''
+
+    def record(self, row):
+        return {name: self.value(row, name) for name in self.column_names}
+
+    def query_rows(self, sql, rows, params=()):
+        ## run sql with a '{rows}' placeholder restricted to the given rows, in chunks below the sqlite variable limit
+        if rows is None or len(rows) == self.size:
+            return self.connection.execute(sql.format(rows='1'), params).fetchall()
+        rows = list(rows)
+        results = []
+        for i in range(0, len(rows), 900):
+            chunk = rows[i:i + 900]
+            results += self.connection.execute(sql.format(rows='_row IN (' + ','.join('?' * len(chunk)) + ')'), tuple(params) + tuple(chunk)).fetchall()
+        return results
+
+    def distinct(self, name, rows=None):
+        ## distinct values of a metadata column, over all rows or the given ones
+        return set(value or '' for (value,) in self.query_rows(f'SELECT DISTINCT {quote(name)} FROM records WHERE {{rows}}', rows))
+
+    def patient_count(self):
+        if self.patient_total is None:
+            self.patient_total = self.connection.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+        return self.patient_total
+
+    def where(self, patient_id="All", record_type="All", record_id="All", start_date=None, end_date=None):
+        ## WHERE clause and parameters of a droplist selection and date window
+        conditions = []
+        params = []
+        for name, value in ((PATIENT_ID, patient_id), (RECORD_TYPE, record_type), (RECORD_ID, record_id)):
+            if value != "All":
+                conditions.append(f'{quote(name)} = ?')
+                params.append(value)
+        if start_date is not None or end_date is not None:
+            conditions.append('_date BETWEEN ? AND ?')
+            params += [NO_DATE + 1 if start_date is None else start_date, 2 ** 63 - 1 if end_date is None else end_date]
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+    def select(self, patient_id="All", record_type="All", record_id="All", start_date=None, end_date=None):
+        ## rows matching the droplist selection, "All" matches everything
+        where, params = self.where(patient_id, record_type, record_id, start_date, end_date)
+        return [row for (row,) in self.connection.execute(f'SELECT _row FROM records{where} ORDER BY _row', params)]
+
+    def record_ids(self, patient_id="All", record_type="All", start_date=None, end_date=None):
+        ## RecordIDs for the record droplist, of a patient and/or a record type, in Record_Date order
+        where, params = self.where(patient_id, record_type, "All", start_date, end_date)
+        cursor = self.connection.execute(f'SELECT RecordID FROM records{where} ORDER BY _date, _row', params)
+        return list(dict.fromkeys(record_id or '' for (record_id,) in cursor))
+
+    def next_date(self, patient_id="All", record_type="All", value=0, direction=1):
+        ## first Record_Date after value (direction 1) or last one before it (direction -1), None if there is none
+        if direction > 0:
+            where, params = self.where(patient_id, record_type, "All", value + 1, None)
+            return self.connection.execute(f'SELECT MIN(_date) FROM records{where}', params).fetchone()[0]
+        if value <= NO_DATE + 1:
+            return None
+        where, params = self.where(patient_id, record_type, "All", None, value - 1)
+        return self.connection.execute(f'SELECT MAX(_date) FROM records{where}', params).fetchone()[0]
+
+    def patient_summaries(self, rows=None):
+        ## record count, first and last Record_Date of every patient with records in the given rows (all patients
+        ## by default), read from the patients summary table
+        ## patients in the order of their first record, like the in-memory store
+        sql = ('SELECT PatientID, record_count, start_date, end_date, '
+               '(SELECT MIN(_row) FROM records WHERE records.PatientID = patients.PatientID) AS first_row FROM patients')
+        if rows is not None and len(rows) != self.size:
+            patient_ids = sorted(self.distinct(PATIENT_ID, rows))
+            results = []
+            for i in range(0, len(patient_ids), 900):
+                chunk = patient_ids[i:i + 900]
+                results += self.connection.execute(sql + ' WHERE PatientID IN (' + ','.join('?' * len(chunk)) + ')', chunk).fetchall()
+            results.sort(key=lambda result: result[4])
+        else:
+            results = self.connection.execute(sql + ' ORDER BY first_row').fetchall()
+        return {patient_id: {'record_count': record_count, 'start_date': start_date or '', 'end_date': end_date or ''}
+                for patient_id, record_count, start_date, end_date, first_row in results}
+
+
+## parsed dataset cache, a binary sidecar file next to the source file
+def cache_path(file_path):
+    return os.path.splitext(file_path)[0] + '_cora_cache.pkl'
+
+
+def sqlite_path(file_path):
+    return os.path.splitext(file_path)[0] + '_cora.sqlite'
+
+
+def remove_sqlite(db_path):
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def create_store(file_path, source=None, use_sqlite=False):
+    ## empty store for the records of file_path, in memory or in a new sidecar SQLite database
+    if not use_sqlite:
+        return RecordStore(source)
+    db_path = sqlite_path(file_path)
+    remove_sqlite(db_path)
+    return SqliteRecordStore(db_path, source, create=True)
+
+
+def file_fingerprint(file_path, sample_count=16, sample_size=1 << 16):
+    ## size, mtime and a hash of evenly spaced samples of the content, cheap even for multi-GB files
+    stat = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        step = max(stat.st_size // sample_count, sample_size)
+        for offset in range(0, stat.st_size, step):
+            f.seek(offset)
+            digest.update(f.read(sample_size))
+        f.seek(max(stat.st_size - sample_size, 0))
+        digest.update(f.read(sample_size))
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+
+
+def dataset_fingerprint(file_paths):
+    ## fingerprint of a single file or of every shard of a folder
+    if len(file_paths) == 1:
+        return file_fingerprint(file_paths[0])
+    return {'files': [[os.path.basename(file_path), file_fingerprint(file_path)] for file_path in file_paths]}
+
+
+def save_store_cache(store, file_path):
+    ## header (version and fingerprint of the source when it was read) followed by the pickled store,
+    ## written to a temporary file first so an interrupted save never leaves a broken cache
+    if isinstance(store, SqliteRecordStore):
+        ## the database is already on disk, only mark it as complete for this version of the file
+        store.set_meta('cache', json.dumps({'version': CACHE_VERSION, 'fingerprint': store.fingerprint}))
+        return
+    path = cache_path(file_path)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'fingerprint': store.fingerprint}, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(store, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print("Failed to write dataset cache:", e)
+
+
+def load_store_cache(file_path, fingerprint, source=None, use_sqlite=False):
+    ## the cached store of file_path, or None if there is no cache or the file changed since it was written
+    if use_sqlite:
+        db_path = sqlite_path(file_path)
+        if not os.path.exists(db_path) or not is_cora_database(db_path):
+            return None
+        store = SqliteRecordStore(db_path, source)
+        if json.loads(store.get_meta('cache', '{}')) != {'version': CACHE_VERSION, 'fingerprint': fingerprint}:
+            store.connection.close()
+            return None
+        store.fingerprint = fingerprint
+        return store
+    path = cache_path(file_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('version') != CACHE_VERSION or header.get('fingerprint') != fingerprint:
+                return None
+            store = pickle.load(f)
+    except Exception as e:
+        print("Failed to read dataset cache:", e)
+        return None
+    if source is not None:
+        store.source = source
+    return store
@@ -4,17 +4,26 @@
  # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
  '''
 # -*- coding: utf-8 -*-
-import re, time
+import time
+import os
 import sys
+import glob
+import bisect
 import csv
 import pickle
-import xml.etree.ElementTree as ET
+from cora_reader import open_row_source, DATA_FILE_PATTERNS, DATA_FILE_FILTER
+from cora_workers import LoadWorker, ShardLoadWorker, SearchIndexWorker, KeywordMatchWorker, PrefetchWorker, SpanWorker
+from cora_render import format_record, render_view, schema_fingerprint, keyword_matcher, record_keyword_spans, SpanCache, RenderCache, VIEW_PAGE_SIZE, VIEW_WINDOW_PAGES
+from cora_highlight import SpanHighlighter
+from cora_search import match_spans
+from cora_store import RecordStore, SqliteRecordStore, create_store, dataset_fingerprint, is_cora_database, load_store_cache, save_store_cache
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
-                             QPushButton, QLabel, QLineEdit, QTextEdit, QTableWidget, 
+                             QPushButton, QLabel, QLineEdit, QPlainTextEdit, QTableWidget, 
                              QTableWidgetItem, QHeaderView, QFileDialog, QMessageBox, QInputDialog,
-                             QListWidget, QComboBox, QDateEdit, QRadioButton, QButtonGroup, QGridLayout, QCheckBox)
+                             QListWidget, QComboBox, QDateEdit, QRadioButton, QButtonGroup, QGridLayout, QCheckBox,
+                             QProgressBar, QSpinBox, QTreeWidget, QTreeWidgetItem)
+from PyQt5.QtGui import QKeySequence
 from PyQt5.QtCore import Qt, QDateTime, QTime,  QDate, QTimer
-from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtGui import QColor, QTextCharFormat, QTextCursor, QTextDocument
 from PyQt5.QtCore import QRegularExpression
 ## enable adjust column width of annotation panel
@@ -52,8 +61,8 @@ class AnnotationTool(QMainWindow):
         self.csv_file_path = None
         self.column_names = []
         self.title_list = []
-        self.records = []
-        self.filtered_records = []
+        self.records = RecordStore()  # columnar store of the loaded records
+        self.filtered_records = []  # rows of self.records selected by the droplists
         self.is_switching_levels = False ## if switching annotation level, patient vs record
         self._is_updating = False  # if the annotation table is updating
         self.custom_column_count = 0  # To keep track of added columns
@@ -67,6 +76,29 @@ class AnnotationTool(QMainWindow):
         self.load_keywords = {}
         self.extend_keywords = []
         self.annotation_start_times = {}
+        self.load_worker = None  # background file loading thread
+        self.dataset_path = None  # loaded file, folder or database
+        self.refresh_fingerprint = None  # fingerprint of the file when its appended rows are being loaded
+        self.load_cancelled = False  # the last load was cancelled, a refresh loads the rest of the file
+        self.search_worker = None  # background search index building thread
+        self.search_index = None  # full-text index of the note bodies, None until it is built
+        self.search_query = ""  # query of the shown search results, its terms are highlighted
+        self.keyword_match_worker = None  # background keyword matching thread
+        self.keyword_hits = None  # (rows with a keyword hit, rows with only a power highlight hit), None until matched
+        self.keyword_hit_cache = {}  # power highlight on/off -> (rows, PatientIDs, RecordIDs) with a hit
+        self.keyword_match_key = None  # (keywords, power keywords, whole word) keyword_hits were matched for
+        self.keyword_match_rows = 0  # keyword_hits cover the rows before this one
+        self.current_view = None  # cora_render view of the displayed text
+        self.window_start = 0  # the displayed text shows the records window_start..window_end of filtered_records
+        self.window_end = 0
+        self.prefetch_worker = None  # background rendering of the next patients
+        self.prefetched_views = {}  # PatientID -> view rendered in the background
+        self.span_worker = None  # background spans of the shown view
+        self.span_cache = SpanCache()  # keyword spans per record, a note shown again is not searched again
+        self.render_cache = RenderCache()  # display text per record, a note shown again is not formatted again
+        self.navigation_direction = 1  # direction of the last next (1) / previous (-1) move, the patients ahead are prefetched
+        self.patient_id_list = []  # sorted items of the patient droplist
+        self.record_type_list = []  # sorted items of the record type droplist
         self.initUI()
         
         self.current_patient_id = "All"
@@ -87,6 +119,17 @@ class AnnotationTool(QMainWindow):
         self.statusBar.addPermanentWidget(self.total_time_cost_label)
         self.statusBar.addPermanentWidget(self.current_case_time_label)
 
+        # Progress bar and cancel button for background file loading
+        self.load_progress_bar = QProgressBar()
+        self.load_progress_bar.setRange(0, 1000)
+        self.load_progress_bar.setMaximumWidth(320)
+        self.load_progress_bar.hide()
+        self.cancel_load_button = QPushButton("Cancel Loading")
+        self.cancel_load_button.clicked.connect(lambda: self.cancel_loading())
+        self.cancel_load_button.hide()
+        self.statusBar.addWidget(self.load_progress_bar)
+        self.statusBar.addWidget(self.cancel_load_button)
+
         # Start timer for updating status bar
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update_status_bar)
@@ -97,7 +140,6 @@ class AnnotationTool(QMainWindow):
         self.current_case_start_time = QDateTime.currentDateTime()
         
         self.keywords = []
-        self.match_pattern = ""
 
     def initUI(self):
         self.setWindowTitle('CORA-UC2')
@@ -113,9 +155,21 @@ class AnnotationTool(QMainWindow):
         
         load_level_layout = QHBoxLayout()
         ## add file load button
-        self.load_button = QPushButton("Load XML File")
+        self.load_button = QPushButton("Load Data File")
         self.load_button.clicked.connect(self.load_file)
         load_level_layout.addWidget(self.load_button)
+        ## add folder load button, all data files of the folder are loaded as one dataset
+        self.load_folder_button = QPushButton("Load Folder")
+        self.load_folder_button.clicked.connect(self.load_folder)
+        load_level_layout.addWidget(self.load_folder_button)
+        ## add refresh button, rows appended to the loaded file are added without reading it again
+        self.refresh_button = QPushButton("Load New Rows")
+        self.refresh_button.clicked.connect(self.refresh_dataset)
+        load_level_layout.addWidget(self.refresh_button)
+        ## keep the loaded records in a SQLite database next to the file instead of in memory
+        self.sqlite_store_checkbox = QCheckBox("SQLite Store")
+        self.sqlite_store_checkbox.setChecked(False)
+        load_level_layout.addWidget(self.sqlite_store_checkbox)
         # ##  TODO: load project
         # self.load_project_button = QPushButton("Load Project")
         # self.load_project_button.clicked.connect(self.load_project)
@@ -155,6 +209,25 @@ class AnnotationTool(QMainWindow):
         filter_layout.addWidget(self.record_id_label)
         filter_layout.addWidget(self.record_id_combo)
         left_panel.addLayout(filter_layout)
+
+        ## next/previous patient (record at record level), the next patients are rendered in the background
+        navigation_layout = QHBoxLayout()
+        self.previous_button = QPushButton("< Previous")
+        self.previous_button.setShortcut(QKeySequence("Alt+Left"))
+        self.previous_button.setToolTip("Previous patient or record (Alt+Left)")
+        self.previous_button.clicked.connect(lambda: self.navigate(-1))
+        self.next_button = QPushButton("Next >")
+        self.next_button.setShortcut(QKeySequence("Alt+Right"))
+        self.next_button.setToolTip("Next patient or record (Alt+Right)")
+        self.next_button.clicked.connect(lambda: self.navigate(1))
+        self.next_unannotated_button = QPushButton("Next Unannotated >>")
+        self.next_unannotated_button.setShortcut(QKeySequence("Alt+Down"))
+        self.next_unannotated_button.setToolTip("Next patient or record without annotation (Alt+Down)")
+        self.next_unannotated_button.clicked.connect(lambda: self.navigate(1, unannotated=True))
+        navigation_layout.addWidget(self.previous_button)
+        navigation_layout.addWidget(self.next_button)
+        navigation_layout.addWidget(self.next_unannotated_button)
+        left_panel.addLayout(navigation_layout)
         
         additional_filter_layout = QHBoxLayout()
         self.record_type_label = QLabel("Record Type:")
@@ -168,8 +241,35 @@ class AnnotationTool(QMainWindow):
         self.power_highlight_checkbox.setChecked(False)  # Set to unchecked by default
         self.power_highlight_checkbox.stateChanged.connect(self.update_keyword_entry)
         additional_filter_layout.addWidget(self.power_highlight_checkbox)
+        ## only highlight (and count as hits) the keywords that stand as whole words, not inside longer words
+        self.whole_word_checkbox = QCheckBox("Whole Word")
+        self.whole_word_checkbox.setChecked(False)
+        self.whole_word_checkbox.stateChanged.connect(self.update_keyword_entry)
+        self.whole_word_checkbox.stateChanged.connect(self.start_keyword_match)
+        additional_filter_layout.addWidget(self.whole_word_checkbox)
+        ## only show the records (and patients) with a hit of the keywords, from the precomputed keyword matches
+        self.hits_filter_checkbox = QCheckBox("Only Records with Hits")
+        self.hits_filter_checkbox.setChecked(False)
+        self.hits_filter_checkbox.stateChanged.connect(self.apply_hits_filter)
+        self.power_highlight_checkbox.stateChanged.connect(lambda: self.hits_filter_checkbox.isChecked() and self.apply_hits_filter())
+        additional_filter_layout.addWidget(self.hits_filter_checkbox)
         
         left_panel.addLayout(additional_filter_layout)
+
+        ## full-text search over all notes, results are the matching patients (best first) with their matching records
+        search_layout = QHBoxLayout()
+        self.search_entry = QLineEdit()
+        self.search_entry.setPlaceholderText("Search all notes, \"quoted phrase\"")
+        self.search_entry.returnPressed.connect(self.run_search)
+        self.search_button = QPushButton("Search")
+        self.search_button.clicked.connect(self.run_search)
+        search_layout.addWidget(self.search_entry)
+        search_layout.addWidget(self.search_button)
+        left_panel.addLayout(search_layout)
+        self.search_results = QTreeWidget()
+        self.search_results.setHeaderLabels(['Patient / Record', 'Hits', 'Score'])
+        self.search_results.itemClicked.connect(self.on_search_result_selected)
+        left_panel.addWidget(self.search_results)
         
         # Connect droplist selection change events
         self.patient_id_combo.currentTextChanged.connect(self.on_patient_id_changed)
@@ -192,6 +292,7 @@ class AnnotationTool(QMainWindow):
         self.keyword_entry = QLineEdit()
         keyword_layout.addWidget(self.keyword_entry)
         self.keyword_entry.returnPressed.connect(self.update_keyword_entry)
+        self.keyword_entry.returnPressed.connect(self.start_keyword_match)
         left_panel.addLayout(keyword_layout)
         
         # Highlight third row, keyword table
@@ -239,10 +340,44 @@ class AnnotationTool(QMainWindow):
 
         # Text display area
         self.text_display = AnnotationTextEdit(self)
+        ## keyword, title and search highlights, drawn over the shown part of the text, the document is not formatted
+        self.text_highlighter = SpanHighlighter(self.text_display)
         
         ## set text display module non-editable, but can be selected and highlighted
         self.text_display.setTextInteractionFlags(Qt.TextSelectableByMouse | Qt.TextSelectableByKeyboard)
         right_panel.addWidget(self.text_display, 3)
+        ## large selections (e.g. "All") are shown a page of records at a time, only the shown pages are rendered.
+        ## without "Paged" the next (previous) page is loaded when scrolling past the end (start) of the text
+        ## the window is checked once the scrolling and the layout settled, the range of the scroll bar is only
+        ## exact for the blocks laid out so far
+        self.window_timer = QTimer()
+        self.window_timer.setSingleShot(True)
+        self.window_timer.setInterval(0)
+        self.window_timer.timeout.connect(self.on_text_scrolled)
+        self.text_display.verticalScrollBar().valueChanged.connect(lambda: self.window_timer.start())
+        self.text_display.verticalScrollBar().rangeChanged.connect(lambda: self.window_timer.start())
+        page_layout = QHBoxLayout()
+        self.paged_checkbox = QCheckBox("Paged")
+        self.paged_checkbox.setChecked(False)
+        self.paged_checkbox.stateChanged.connect(self.on_page_settings_changed)
+        self.page_size_label = QLabel("Records per Page:")
+        self.page_size_spinbox = QSpinBox()
+        self.page_size_spinbox.setRange(10, 10000)
+        self.page_size_spinbox.setValue(VIEW_PAGE_SIZE)
+        self.page_size_spinbox.valueChanged.connect(self.on_page_settings_changed)
+        self.previous_page_button = QPushButton("< Page")
+        self.previous_page_button.clicked.connect(lambda: self.show_record_page(self.window_start - self.page_size_spinbox.value()))
+        self.page_label = QLabel("")
+        self.next_page_button = QPushButton("Page >")
+        self.next_page_button.clicked.connect(lambda: self.show_record_page(self.window_end))
+        page_layout.addWidget(self.paged_checkbox)
+        page_layout.addWidget(self.page_size_label)
+        page_layout.addWidget(self.page_size_spinbox)
+        page_layout.addStretch()
+        page_layout.addWidget(self.previous_page_button)
+        page_layout.addWidget(self.page_label)
+        page_layout.addWidget(self.next_page_button)
+        right_panel.addLayout(page_layout)
 
 
         # Annotation table
@@ -259,31 +394,61 @@ class AnnotationTool(QMainWindow):
         # Connect the header click event add new column
         self.annotation_table.horizontalHeader().sectionClicked.connect(self.onHeaderClicked)
         self.annotation_table.cellChanged.connect(self.on_cell_changed)
-
-        ### TODO: filtering notes with date, patient/record droplist need to be updated based on the availability of records.
-        # ## date filtering
-        # date_layout = QHBoxLayout()
-        # # Start date
-        # start_label = QLabel("Start Date:")
-        # self.start_date = QDateEdit()
-        # self.start_date.setCalendarPopup(True)
-        # self.start_date.setDate(QDate.currentDate().addDays(-30))  # Default to 30 days ago
-        # self.start_date.dateChanged.connect(self.on_date_changed)
+        self.annotation_table.currentCellChanged.connect(self.on_annotation_row_selected)
+
+        ## date filtering, notes are selected by Record_Date with a binary search in the date index.
+        ## the record droplist only lists the records in the date range
+        date_layout = QHBoxLayout()
+        self.date_filter_checkbox = QCheckBox("Date Filter")
+        self.date_filter_checkbox.setChecked(False)
+        self.date_filter_checkbox.stateChanged.connect(self.on_date_changed)
+        # Start date
+        start_label = QLabel("Start Date:")
+        self.start_date = QDateEdit()
+        self.start_date.setCalendarPopup(True)
+        self.start_date.setDate(QDate.currentDate().addDays(-30))  # Default to 30 days ago
+        self.start_date.dateChanged.connect(self.on_date_changed)
         
-        # # End date
-        # end_label = QLabel("End Date:")
-        # self.end_date = QDateEdit()
-        # self.end_date.setCalendarPopup(True)
-        # self.end_date.setDate(QDate.currentDate())  # Default to today
-        # self.end_date.dateChanged.connect(self.on_date_changed)
+        # End date
+        end_label = QLabel("End Date:")
+        self.end_date = QDateEdit()
+        self.end_date.setCalendarPopup(True)
+        self.end_date.setDate(QDate.currentDate())  # Default to today
+        self.end_date.dateChanged.connect(self.on_date_changed)
         
-        # # Add widgets to date layout
-        # date_layout.addWidget(start_label)
-        # date_layout.addWidget(self.start_date)
-        # date_layout.addWidget(end_label)
-        # date_layout.addWidget(self.end_date)
-        # date_layout.addWidget(self.filter_button)
-        # left_panel.insertLayout(1, date_layout)
+        # Add widgets to date layout
+        date_layout.addWidget(self.date_filter_checkbox)
+        date_layout.addWidget(start_label)
+        date_layout.addWidget(self.start_date)
+        date_layout.addWidget(end_label)
+        date_layout.addWidget(self.end_date)
+        left_panel.insertLayout(1, date_layout)
+
+        ## index date, the date filter is set to +/- N days around it. Earlier/Later move the index date
+        ## to the closest notes of the selection before/after the current window
+        index_date_layout = QHBoxLayout()
+        index_date_label = QLabel("Index Date:")
+        self.index_date = QDateEdit()
+        self.index_date.setCalendarPopup(True)
+        self.index_date.setDate(QDate.currentDate())
+        window_days_label = QLabel("+/- Days:")
+        self.window_days = QSpinBox()
+        self.window_days.setRange(0, 36500)
+        self.window_days.setValue(30)
+        self.window_button = QPushButton("Window")
+        self.window_button.clicked.connect(self.apply_date_window)
+        self.earlier_button = QPushButton("< Earlier")
+        self.earlier_button.clicked.connect(lambda: self.shift_date_window(-1))
+        self.later_button = QPushButton("Later >")
+        self.later_button.clicked.connect(lambda: self.shift_date_window(1))
+        index_date_layout.addWidget(index_date_label)
+        index_date_layout.addWidget(self.index_date)
+        index_date_layout.addWidget(window_days_label)
+        index_date_layout.addWidget(self.window_days)
+        index_date_layout.addWidget(self.window_button)
+        index_date_layout.addWidget(self.earlier_button)
+        index_date_layout.addWidget(self.later_button)
+        left_panel.insertLayout(2, index_date_layout)
         
         main_layout.addLayout(right_panel, 5)
         main_layout.setStretch(0, 1)  # Left panel
@@ -291,44 +456,578 @@ class AnnotationTool(QMainWindow):
 
     def load_file(self):
         print("load_file.")
-        self.is_switching_levels = True ## assume first load file as switch level to disable annotation saving
-        file_path, _ = QFileDialog.getOpenFileName(self, "Open XML File", "", "XML Files (*.xml)")
+        file_path, _ = QFileDialog.getOpenFileName(self, "Open Data File", "", DATA_FILE_FILTER + ";;CORA Database (*.sqlite *.db)")
         if file_path:
-            self.records = self.parse_xml(file_path)
-            self.filtered_records = self.records.copy()
+            self.open_dataset(file_path, [file_path])
+
+    def load_folder(self):
+        ## a folder of data file shards (e.g. one per month or site) loaded as one dataset
+        folder_path = QFileDialog.getExistingDirectory(self, "Open Folder of Data Files")
+        if folder_path:
+            file_paths = sorted(file_path for pattern in DATA_FILE_PATTERNS for file_path in glob.glob(os.path.join(folder_path, pattern)))
+            if not file_paths:
+                QMessageBox.warning(self, "No Data Files!", f"No data files found in {folder_path}")
+                return
+            print("load_folder: ", folder_path, ", shard number:", len(file_paths))
+            self.open_dataset(folder_path, file_paths)
+
+    def open_dataset(self, dataset_path, file_paths):
+        ## a database that was not written by CORA is not opened, so nothing is written to it
+        if dataset_path.endswith(('.sqlite', '.db')) and not is_cora_database(dataset_path):
+            QMessageBox.warning(self, "Not a CORA Database!", f"{dataset_path} is not a CORA database, it is left unchanged.")
+            return
+        self.is_switching_levels = True ## assume first load file as switch level to disable annotation saving
+        self.cancel_loading(wait=True)
+        self.stop_search_index()
+        self.search_index = None
+        self.stop_keyword_match()
+        self.stop_prefetch()
+        self.prefetched_views = {}
+        self.stop_span_worker()
+        self.span_cache.clear()
+        self.render_cache.clear()
+        self.current_view = None
+        self.keyword_hits = None
+        self.keyword_hit_cache = {}
+        self.search_query = ""
+        self.search_results.clear()
+        self.records.close()
+        self.filtered_records = []
+        self.dataset_path = dataset_path
+        # Set CSV file path
+        if self.patient_level_radio.isChecked():
+            self.csv_file_path = os.path.splitext(dataset_path)[0] + '_patient_annotations.csv'
+        else:
+            self.csv_file_path = os.path.splitext(dataset_path)[0] + '_note_annotations.csv'
+        # Reset total time cost and current case time
+        self.total_time_cost = 0
+        self.current_case_start_time = QDateTime.currentDateTime()
+        use_sqlite = self.sqlite_store_checkbox.isChecked()
+        if dataset_path.endswith(('.sqlite', '.db')):
+            ## database input, records are queried from it directly
+            cached_records = SqliteRecordStore(dataset_path)
+        else:
+            ## reuse the parsed dataset of unchanged files
+            fingerprint = dataset_fingerprint(file_paths)
+            cached_records = load_store_cache(dataset_path, fingerprint, open_row_source(file_paths), use_sqlite)
+        if cached_records is not None:
+            print("load dataset cache for: ", dataset_path)
+            self.records = cached_records
+            self.column_names = self.records.column_names
             self.update_droplists()
             self.update_display()
-            # Set CSV file path
-            if self.patient_level_radio.isChecked():
-                self.csv_file_path = file_path.rsplit('.', 1)[0] + '_patient_annotations.csv'
-            else:
-                self.csv_file_path = file_path.rsplit('.', 1)[0] + '_note_annotations.csv'
-            # Reset total time cost and current case time
-            self.total_time_cost = 0
-            self.current_case_start_time = QDateTime.currentDateTime()
+            self.statusBar.showMessage(f"Loaded {len(self.records)} rows from cache.", 5000)
+            self.is_switching_levels = False
+            self.start_search_index()
+            self.start_keyword_match()
+            return
+        ## only metadata is kept in memory, note bodies are read from the mapped file when displayed
+        self.records = create_store(dataset_path, open_row_source(file_paths), use_sqlite)
+        self.records.fingerprint = fingerprint
+        self.load_cancelled = False
+        ## parse in background, records are streamed back in batches
+        if len(file_paths) == 1:
+            load_worker = LoadWorker(file_paths[0])
+        else:
+            load_worker = ShardLoadWorker(file_paths)
+            load_worker.duplicates_found.connect(self.on_duplicates_found)
+        self.start_load_worker(load_worker)
         self.is_switching_levels = False
-        
-    def parse_xml(self, file_path):
-        print("parse_xml for file: ", file_path)
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        records = []
-        for row in root.findall('ROW'):
-            record = {}
-            for column in row.findall('COLUMN'):
-                name = column.get('NAME')
-                if name not in self.column_names:
-                    self.column_names.append(name)
-                value = column.text.strip() if column.text else ""
-                record[name] = value
-            records.append(record)
-        return records
 
+    def refresh_dataset(self):
+        ## load only the rows appended to the data file since it was read, annotations and timing are kept
+        if self.load_worker is not None and self.load_worker.isRunning():
+            self.statusBar.showMessage("The file is still loading.", 5000)
+            return
+        if self.dataset_path is None or not os.path.isfile(self.dataset_path) or self.dataset_path.endswith(('.sqlite', '.db')):
+            self.statusBar.showMessage("Only a loaded data file can be refreshed.", 5000)
+            return
+        if len(self.records) == 0:
+            self.open_dataset(self.dataset_path, [self.dataset_path])
+            return
+        fingerprint = dataset_fingerprint([self.dataset_path])
+        if fingerprint == self.records.fingerprint and not self.load_cancelled:
+            self.statusBar.showMessage("No new rows.", 5000)
+            return
+        ## without the span of the last row there is no offset to resume from, the file is read again
+        last_span = self.records.last_span()
+        if last_span is None:
+            self.open_dataset(self.dataset_path, [self.dataset_path])
+            return
+        print("refresh_dataset: ", self.dataset_path)
+        self.refresh_fingerprint = fingerprint
+        if self.records.source is not None:
+            self.records.source.close()  # mapped again with the new file size on the next read
+        last_row = len(self.records) - 1
+        load_worker = LoadWorker(self.dataset_path, resume=(last_span[0], self.records.record_id(last_row)))
+        load_worker.resume_failed.connect(self.on_resume_failed)
+        self.start_load_worker(load_worker)
+
+    def start_load_worker(self, load_worker):
+        self.load_worker = load_worker
+        self.load_worker.batch_loaded.connect(self.on_records_loaded)
+        self.load_worker.progress.connect(self.on_load_progress)
+        self.load_worker.load_finished.connect(self.on_load_finished)
+        self.load_worker.load_failed.connect(self.on_load_failed)
+        self.load_progress_bar.setValue(0)
+        self.load_progress_bar.setFormat("Loading...")
+        self.load_progress_bar.show()
+        self.cancel_load_button.show()
+        self.load_worker.start()
+
+    def cancel_loading(self, wait=False):
+        if self.load_worker is not None and self.load_worker.isRunning():
+            self.load_worker.requestInterruption()
+            if wait:
+                self.load_worker.wait()
+
+    def on_records_loaded(self, records, spans):
+        if self.sender() is not self.load_worker:
+            return  # batch from a cancelled load that was still queued
+        first_batch = len(self.records) == 0
+        rows = self.records.extend(records, spans)
+        self.column_names = self.records.column_names
+        self.is_switching_levels = True
+        if first_batch:
+            ## first patients are browsable while the rest of the file is still loading
+            self.update_droplists()
+            self.update_display()
+        else:
+            self.extend_droplists(rows)
+            selected_patient = self.patient_id_combo.currentText()
+            if selected_patient != "All" and any(self.records.patient_id(row) == selected_patient for row in rows):
+                ## same case with more records, keep its annotation time running
+                case_start_time = self.current_case_start_time
+                self.update_display()
+                self.current_case_start_time = case_start_time
+        self.is_switching_levels = False
+
+    def on_load_progress(self, row_count, bytes_read, total_bytes):
+        if self.sender() is not self.load_worker:
+            return
+        if total_bytes > 0:
+            self.load_progress_bar.setValue(int(1000 * bytes_read / total_bytes))
+        self.load_progress_bar.setFormat(f"{row_count} rows, {bytes_read / 1048576:.1f} / {total_bytes / 1048576:.1f} MB")
+
+    def on_load_finished(self, row_count, cancelled):
+        if self.sender() is not self.load_worker:
+            return
+        self.load_progress_bar.hide()
+        self.cancel_load_button.hide()
+        self.is_switching_levels = True
+        case_start_time = self.current_case_start_time  # same case with more records, keep its annotation time running
+        ## the record droplist only got the first batch, refresh it for the current selection
+        selected_patient = self.patient_id_combo.currentText()
+        selected_record_type = self.record_type_combo.currentText()
+        selected_record = self.record_id_combo.currentText()
+        if selected_patient != "All":
+            self.update_record_id_droplist_with_patient(selected_patient)
+        else:
+            self.update_record_id_droplist_with_record_type(selected_record_type)
+        self.record_id_combo.blockSignals(True)
+        self.record_id_combo.setCurrentIndex(max(0, self.record_id_combo.findText(selected_record)))
+        self.record_id_combo.blockSignals(False)
+        if selected_patient == "All":
+            self.update_display()
+        self.current_case_start_time = case_start_time
+        self.is_switching_levels = False
+        self.load_cancelled = cancelled
+        if cancelled:
+            self.statusBar.showMessage(f"Loading cancelled, {row_count} rows loaded.", 5000)
+        else:
+            if getattr(self.load_worker, 'resume', None) is not None:
+                self.records.fingerprint = self.refresh_fingerprint
+            save_store_cache(self.records, self.dataset_path)
+            self.statusBar.showMessage(f"Loading complete, {row_count} rows loaded.", 5000)
+            ## index and match only the new rows, after a refresh the index and hits of the earlier rows are kept
+            self.start_search_index()
+            self.start_keyword_match(appended=True)
+
+    def on_duplicates_found(self, duplicates):
+        if self.sender() is not self.load_worker:
+            return
+        examples = "\n".join(f"{record_id} ({os.path.basename(file_path)})" for record_id, file_path in duplicates[:10])
+        QMessageBox.warning(self, "Duplicate Record IDs!", f"{len(duplicates)} rows have a RecordID that was already loaded from an earlier file, only the first one is kept:\n{examples}")
+
+    def on_resume_failed(self):
+        if self.sender() is not self.load_worker:
+            return
+        self.load_progress_bar.hide()
+        self.cancel_load_button.hide()
+        reply = QMessageBox.question(self, "File Changed!", "The file was changed, not only appended to. Reload it completely?",
+                                     QMessageBox.Yes | QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            self.open_dataset(self.dataset_path, [self.dataset_path])
+
+    def on_load_failed(self, message):
+        if self.sender() is not self.load_worker:
+            return
+        self.load_progress_bar.hide()
+        self.cancel_load_button.hide()
+        QMessageBox.critical(self, "Load Failed!", f"An error occurred while loading: {message}")
+
+    def start_search_index(self):
+        self.stop_search_index()
+        self.search_worker = SearchIndexWorker(self.records, self.dataset_path, self.search_index)
+        self.search_worker.progress.connect(self.on_search_index_progress)
+        self.search_worker.index_finished.connect(self.on_search_index_finished)
+        self.search_index = None  # extended by the worker, searched again once it is finished
+        self.search_worker.start()
+
+    def stop_search_index(self):
+        if self.search_worker is not None and self.search_worker.isRunning():
+            self.search_worker.requestInterruption()
+            self.search_worker.wait()
+
+    def on_search_index_progress(self, row_count, total_rows):
+        if self.sender() is not self.search_worker:
+            return
+        self.statusBar.showMessage(f"Indexing notes for search: {row_count} / {total_rows}", 2000)
+
+    def on_search_index_finished(self, search_index):
+        if self.sender() is not self.search_worker:
+            return
+        self.search_index = search_index
+        self.statusBar.showMessage(f"Search index ready, {len(search_index)} notes.", 5000)
+
+    def run_search(self, max_patients=200, max_records=50):
+        ## ranked patients and records for the query, the records of a patient are listed under it
+        query = self.search_entry.text().strip()
+        self.search_results.clear()
+        self.search_query = query
+        if not query:
+            return
+        if self.search_index is None:
+            self.statusBar.showMessage("The search index is still being built.", 5000)
+            return
+        start_time = QDateTime.currentMSecsSinceEpoch()
+        records, patients = self.search_index.search(query)
+        for patient_score, patient_id, hits in patients[:max_patients]:
+            patient_item = QTreeWidgetItem([patient_id, str(len(hits)), f"{patient_score:.2f}"])
+            patient_item.setData(0, Qt.UserRole, patient_id)
+            for score, row in hits[:max_records]:
+                record_item = QTreeWidgetItem([self.records.record_id(row) + "  " + self.records.record_date(row), "", f"{score:.2f}"])
+                record_item.setData(0, Qt.UserRole, patient_id)
+                record_item.setData(0, Qt.UserRole + 1, row)
+                patient_item.addChild(record_item)
+            self.search_results.addTopLevelItem(patient_item)
+        time_cost = QDateTime.currentMSecsSinceEpoch() - start_time
+        print("search:", query, ", patients:", len(patients), ", records:", len(records), ", time cost (ms):", time_cost)
+        self.statusBar.showMessage(f"{len(patients)} patients, {len(records)} notes match ({time_cost} ms).", 5000)
+
+    def on_search_result_selected(self, item):
+        ## show the patient (or the record) of a search result with the hits highlighted, scrolled to the first hit
+        patient_index = self.patient_id_combo.findText(item.data(0, Qt.UserRole))
+        if patient_index < 0:
+            return
+        self.patient_id_combo.setCurrentIndex(patient_index)
+        row = item.data(0, Qt.UserRole + 1)
+        record_index = 0
+        if row is not None:
+            record_index = self.record_id_combo.findText(self.records.record_id(row))
+            if record_index < 0:
+                self.statusBar.showMessage("The record is hidden by the record type or date filter.", 5000)
+                record_index = 0
+        self.record_id_combo.setCurrentIndex(record_index)
+        self.highlight_search_hits()
+        spans = match_spans(self.text_display.toPlainText(), self.search_query)
+        if spans:
+            cursor = self.text_display.textCursor()
+            cursor.setPosition(spans[0][0])
+            self.text_display.setTextCursor(cursor)
+            self.text_display.ensureCursorVisible()
+
+    def highlight_search_hits(self):
+        ## mark the terms of the last search in the displayed text, the highlighter finds them in the blocks it shows
+        if not self.search_query:
+            self.text_highlighter.clear_layer('search')
+            return
+        highlight_format = QTextCharFormat()
+        highlight_format.setBackground(QColor(Qt.cyan))
+        query = self.search_query
+        self.text_highlighter.set_layer('search', highlight_format, lambda text: match_spans(text, query))
+
+    def start_keyword_match(self, appended=False):
+        ## match the keyword list against every note in the background, the hits filter reads the result.
+        ## appended: rows were only added to the store (a refresh), for the same keywords only they are matched
+        self.stop_keyword_match()
+        keywords = [keyword for keyword in self.keyword_entry.text().split(',') if keyword.strip()]
+        keywords += self.load_keywords.keys()
+        whole_word = self.whole_word_checkbox.isChecked()
+        start_row = 0
+        if appended and self.keyword_hits is not None and self.keyword_match_key == (frozenset(keywords), frozenset(self.extend_keywords), whole_word):
+            start_row = self.keyword_match_rows
+        else:
+            self.keyword_hits = None
+            self.keyword_hit_cache = {}
+        if not keywords or len(self.records) == 0:
+            if self.hits_filter_checkbox.isChecked():
+                self.apply_hits_filter()
+            return
+        self.keyword_match_worker = KeywordMatchWorker(self.records, keywords, self.extend_keywords, whole_word, start_row=start_row)
+        self.keyword_match_worker.progress.connect(self.on_keyword_match_progress)
+        self.keyword_match_worker.matches_found.connect(self.on_keyword_matches_found)
+        self.keyword_match_worker.start()
+
+    def stop_keyword_match(self):
+        if self.keyword_match_worker is not None and self.keyword_match_worker.isRunning():
+            self.keyword_match_worker.requestInterruption()
+            self.keyword_match_worker.wait()
+
+    def on_keyword_match_progress(self, row_count, total_rows):
+        if self.sender() is not self.keyword_match_worker:
+            return
+        self.statusBar.showMessage(f"Matching keywords: {row_count} / {total_rows}", 2000)
+
+    def on_keyword_matches_found(self, keyword_rows, power_rows):
+        worker = self.sender()
+        if worker is not self.keyword_match_worker:
+            return
+        if worker.start_row > 0:
+            ## hits of the appended rows, added to those of the rows before
+            keyword_rows |= self.keyword_hits[0]
+            power_rows |= self.keyword_hits[1]
+        self.keyword_hits = (keyword_rows, power_rows)
+        self.keyword_match_key = (frozenset(worker.keywords), frozenset(worker.power_keywords), worker.whole_word)
+        self.keyword_match_rows = worker.row_count
+        self.keyword_hit_cache = {}
+        self.statusBar.showMessage(f"{len(keyword_rows)} notes with keyword hits, {len(keyword_rows) + len(power_rows)} with power highlight.", 5000)
+        if self.hits_filter_checkbox.isChecked():
+            self.apply_hits_filter()
+
+    def keyword_hit_filter(self):
+        ## (rows, PatientIDs, RecordIDs) with at least one keyword hit while the hits filter is on, otherwise None
+        if not self.hits_filter_checkbox.isChecked() or self.keyword_hits is None:
+            return None
+        power_highlight = self.power_highlight_checkbox.isChecked()
+        hits = self.keyword_hit_cache.get(power_highlight)
+        if hits is None:
+            rows = self.keyword_hits[0] | self.keyword_hits[1] if power_highlight else self.keyword_hits[0]
+            hits = (rows, self.records.distinct('PatientID', rows), self.records.distinct('RecordID', rows))
+            self.keyword_hit_cache[power_highlight] = hits
+        return hits
+
+    def hit_patient_ids(self, patient_ids):
+        hits = self.keyword_hit_filter()
+        if hits is None:
+            return patient_ids
+        return [patient_id for patient_id in patient_ids if patient_id in hits[1]]
+
+    def hit_record_ids(self, record_ids):
+        hits = self.keyword_hit_filter()
+        if hits is None:
+            return record_ids
+        return [record_id for record_id in record_ids if record_id in hits[2]]
+
+    def apply_hits_filter(self):
+        ## rebuild the droplists for the hits filter, the selected patient stays selected if it is still listed
+        if self.hits_filter_checkbox.isChecked() and self.keyword_hits is None:
+            if self.keyword_match_worker is not None and self.keyword_match_worker.isRunning():
+                self.statusBar.showMessage("Keywords are still being matched, the filter is applied when they are done.", 5000)
+            else:
+                self.statusBar.showMessage("Enter or load keywords to filter the records with hits.", 5000)
+        selected_patient = self.patient_id_combo.currentText()
+        self.update_droplists()
+        patient_index = self.patient_id_combo.findText(selected_patient)
+        if patient_index > 0:
+            self.patient_id_combo.setCurrentIndex(patient_index)
+        else:
+            self.update_display()
+
+    def selection_rows(self, patient_id, record_type, record_id):
+        ## rows shown for a droplist selection, with the date and hits filters
+        rows = self.records.select(patient_id, record_type, record_id, *self.date_filter())
+        hits = self.keyword_hit_filter()
+        if hits is not None:
+            rows = [row for row in rows if row in hits[0]]
+        return rows
+
+    def keyword_list(self):
+        ## highlighted keywords, kept up to date by keyword_update
+        return self.keywords
+
+    def view_keyword_spans(self, keywords):
+        ## keyword spans of the displayed text: the spans of the prefetched view when it was rendered for these keywords,
+        ## otherwise the matcher, which the highlighter runs on the text blocks as they are shown
+        view = self.current_view
+        whole_word = self.whole_word_checkbox.isChecked()
+        if view is not None and view['keywords'] == frozenset(keywords) and view['whole_word'] == whole_word:
+            return view['keyword_spans']
+        matcher = keyword_matcher(keywords, whole_word)
+        if view is not None:
+            ## records shown before for these keywords are not searched, their spans come from the span cache
+            spans = record_keyword_spans(view, matcher, self.span_cache, search=False)
+            if spans is not None:
+                view['keywords'] = frozenset(keywords)
+                view['whole_word'] = whole_word
+                view['keyword_spans'] = spans
+                return spans
+        return matcher.spans
+
+    def view_title_spans(self):
+        ## title spans of the displayed text, from the offset table of the view
+        view = self.current_view
+        if view is None:
+            return []
+        return view['title_spans']
+
+    def jump_to_record(self, index):
+        ## scroll the note view so that the index-th record of the selection starts at the top, its page is shown
+        ## first when it is not in the window. its position comes from the offset table of the view
+        if self.current_view is None or not 0 <= index < len(self.filtered_records):
+            return
+        if not self.window_start <= index < self.window_end:
+            self.show_record_page(index)
+        self.scroll_to_position(self.current_view['offsets'][index - self.window_start][0])
+
+    def scroll_to_position(self, position, line_offset=0):
+        ## scroll the note view so that the block at position (from its line_offset-th line) is the first one shown.
+        ## the line numbers of the blocks that were not laid out yet are estimates, so the view is scrolled to the end
+        ## and then back up to the block, which lays out the blocks it shows
+        cursor = self.text_display.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        self.text_display.setTextCursor(cursor)
+        self.text_display.ensureCursorVisible()
+        cursor.setPosition(position)
+        self.text_display.setTextCursor(cursor)
+        self.text_display.ensureCursorVisible()
+        if line_offset:
+            scroll_bar = self.text_display.verticalScrollBar()
+            scroll_bar.setValue(scroll_bar.value() + line_offset)
+
+    def on_annotation_row_selected(self, row, column, previous_row, previous_column):
+        ## at record level the rows of the annotation table are the shown records, selecting one shows its note
+        if row >= 0 and row != previous_row and self.record_level_radio.isChecked() and not self.is_switching_levels:
+            self.jump_to_record(row)
+
+    def previous_keyword_spans(self):
+        ## (keywords, spans) the keyword highlight shows for the shown view, when the keywords change with the same
+        ## match mode the highlight is updated from them instead of from scratch
+        view = self.current_view
+        if view is None or view['keyword_spans'] is None or view['whole_word'] != self.whole_word_checkbox.isChecked():
+            return None
+        if self.text_highlighter.layer_spans('keywords') is not view['keyword_spans']:
+            return None
+        return (view['keywords'], view['keyword_spans'])
+
+    def start_span_worker(self, keywords, previous=None):
+        ## keyword spans of the shown view in the background, when it was not rendered with them. until they are
+        ## ready the highlighter matches the shown blocks itself, or keeps the previous keyword spans
+        view = self.current_view
+        whole_word = self.whole_word_checkbox.isChecked()
+        if view is None or (view['keywords'] == frozenset(keywords) and view['whole_word'] == whole_word):
+            return
+        self.span_worker = SpanWorker(view, keywords, whole_word, self.span_cache, previous=previous)
+        self.span_worker.spans_ready.connect(self.on_spans_ready)
+        self.span_worker.start()
+
+    def stop_span_worker(self):
+        if self.span_worker is not None and self.span_worker.isRunning():
+            self.span_worker.requestInterruption()
+            self.span_worker.wait()
+
+    def on_spans_ready(self, view, spans):
+        if self.sender() is not self.span_worker or view is not self.current_view:
+            return
+        view['keywords'] = frozenset(self.span_worker.keywords)
+        view['whole_word'] = self.span_worker.whole_word
+        view['keyword_spans'] = spans
+        if self.span_worker.previous is not None:
+            self.text_highlighter.update_spans('keywords', spans)  # only the blocks of changed keywords
+        else:
+            self.text_highlighter.replace_spans('keywords', spans)
+
+    def navigate(self, direction, unannotated=False):
+        ## move to the next (1) or previous (-1) patient of the droplist, or record at record level,
+        ## with unannotated to the closest one without annotation
+        is_patient_level = self.patient_level_radio.isChecked()
+        combo = self.patient_id_combo if is_patient_level else self.record_id_combo
+        annotations = self.patient_annotations if is_patient_level else self.record_annotations
+        self.navigation_direction = direction
+        index = combo.currentIndex() + direction
+        while 0 < index < combo.count():
+            item = combo.itemText(index)
+            if item != "All" and not (unannotated and self.is_annotated(annotations.get(item, {}))):
+                combo.setCurrentIndex(index)
+                return
+            index += direction
+        level = "patient" if is_patient_level else "record"
+        if unannotated:
+            self.statusBar.showMessage(f"No unannotated {level} after this one.", 3000)
+        else:
+            self.statusBar.showMessage(f"No {'next' if direction > 0 else 'previous'} {level}.", 3000)
+
+    def is_annotated(self, annotation_data):
+        ## any annotation column (after 'Time Cost') filled in
+        headers = self.patient_headers if self.patient_level_radio.isChecked() else self.record_headers
+        return any(annotation_data.get(header, '').strip() for header in headers[headers.index('Time Cost') + 1:-1])
+
+    def prefetch_patients(self, count=2):
+        ## render the next patients of the droplist, in the direction of the last move, while this one is read
+        index = self.patient_id_combo.currentIndex()
+        if index <= 0:
+            return
+        keywords = self.keyword_list()
+        whole_word = self.whole_word_checkbox.isChecked()
+        record_type = self.record_type_combo.currentText()
+        patient_ids = [self.patient_id_combo.currentText()]
+        schema = schema_fingerprint(self.column_names)
+        selections = []
+        for step in range(1, count + 1):
+            next_index = index + step * self.navigation_direction
+            if next_index <= 0 or next_index >= self.patient_id_combo.count():
+                break
+            patient_id = self.patient_id_combo.itemText(next_index)
+            patient_ids.append(patient_id)
+            rows = self.selection_rows(patient_id, record_type, "All")[:self.page_size_spinbox.value()]  # the first page is shown
+            view = self.prefetched_views.get(patient_id)
+            if view is None or view['rows'] != list(rows) or view['schema'] != schema or view['keywords'] != frozenset(keywords) or view['whole_word'] != whole_word:
+                selections.append((patient_id, rows))
+        self.prefetched_views = {patient_id: view for patient_id, view in self.prefetched_views.items() if patient_id in patient_ids}
+        if not selections:
+            return
+        self.stop_prefetch()
+        self.prefetch_worker = PrefetchWorker(self.records, list(self.column_names), selections, keywords, whole_word, self.span_cache, self.render_cache)
+        self.prefetch_worker.view_rendered.connect(self.on_view_rendered)
+        self.prefetch_worker.start()
+
+    def stop_prefetch(self):
+        if self.prefetch_worker is not None and self.prefetch_worker.isRunning():
+            self.prefetch_worker.requestInterruption()
+            self.prefetch_worker.wait()
+
+    def on_view_rendered(self, patient_id, view):
+        if self.sender() is not self.prefetch_worker:
+            return
+        self.prefetched_views[patient_id] = view
+
+    def take_prefetched_view(self, patient_id, rows):
+        ## the prefetched view of the patient (or the shown view) if it shows exactly these rows, it is kept for a
+        ## later call otherwise (the droplists are refilled one at a time, the first update of a switch may see other rows)
+        schema = schema_fingerprint(self.column_names)
+        view = self.prefetched_views.get(patient_id)
+        if view is None or view['rows'] != list(rows) or view['schema'] != schema:
+            if self.current_view is not None and self.current_view['rows'] == list(rows) and self.current_view['schema'] == schema:
+                return self.current_view
+            return None
+        return self.prefetched_views.pop(patient_id)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.window_timer.start()  # a larger viewport may show the whole window
+
+    def closeEvent(self, event):
+        self.cancel_loading(wait=True)
+        self.stop_search_index()
+        self.stop_keyword_match()
+        self.stop_prefetch()
+        self.stop_span_worker()
+        super().closeEvent(event)
+        
     def update_droplists(self):
         print("update_droplists.")
-        patient_ids = set(record['PatientID'] for record in self.records)
-        record_ids = set(record['RecordID'] for record in self.records)
-        record_types = set(record['Record_Type'] for record in self.records)
+        patient_ids = self.hit_patient_ids(self.records.distinct('PatientID'))
+        record_types = self.records.distinct('Record_Type')
         # print(record_types)
         self.patient_id_combo.blockSignals(True)
         self.record_id_combo.blockSignals(True)
@@ -339,13 +1038,15 @@ class AnnotationTool(QMainWindow):
         self.record_type_combo.clear()
          
         self.patient_id_combo.addItem("All")
-        self.patient_id_combo.addItems(sorted(patient_ids))
+        self.patient_id_list = sorted(patient_ids)
+        self.patient_id_combo.addItems(self.patient_id_list)
         
         self.record_id_combo.addItem("All")
-        self.record_id_combo.addItems(sorted(record_ids))
+        self.record_id_combo.addItems(self.hit_record_ids(self.records.record_ids("All", "All", *self.date_filter())))
 
         self.record_type_combo.addItem("All")
-        self.record_type_combo.addItems(sorted(record_types))
+        self.record_type_list = sorted(record_types)
+        self.record_type_combo.addItems(self.record_type_list)
         
         self.patient_id_combo.blockSignals(False)
         self.record_id_combo.blockSignals(False)
@@ -353,27 +1054,35 @@ class AnnotationTool(QMainWindow):
 
         # self.update_record_id_droplist_with_patient("All")
 
+
+    def extend_droplists(self, rows):
+        ## insert the ids of a newly loaded batch into the sorted droplists, without rebuilding them
+        self.insert_droplist_items(self.patient_id_combo, self.patient_id_list, self.hit_patient_ids(self.records.distinct('PatientID', rows)))
+        self.insert_droplist_items(self.record_type_combo, self.record_type_list, self.records.distinct('Record_Type', rows))
+
+    def insert_droplist_items(self, combo, sorted_items, new_items):
+        combo.blockSignals(True)
+        for item in sorted(new_items):
+            index = bisect.bisect_left(sorted_items, item)
+            if index < len(sorted_items) and sorted_items[index] == item:
+                continue
+            sorted_items.insert(index, item)
+            combo.insertItem(index + 1, item)  # keep "All" as the first item
+        combo.blockSignals(False)
+
     def update_keyword_entry(self):
         self.keyword_update()
-        selected_patient = self.patient_id_combo.currentText()
-        full_highlight = True 
-        if selected_patient == 'All':
-            full_highlight = False 
-        self.highlight_keywords(full_highlight)
+        self.highlight_keywords()
 
     def update_record_id_droplist_with_patient(self, selected_patient):
         print("update_record_id_droplist_with_patient.")
         self.record_id_combo.blockSignals(True)
         self.record_id_combo.clear()
-        if selected_patient == "All":
-            self.record_id_combo.addItem("All")
-            record_ids = set(record['RecordID'] for record in self.records)
-        else:
-            record_ids = set(record['RecordID'] for record in self.records if record['PatientID'] == selected_patient)
+        ## records of the patient (and of the selected record type) from the indexes, in Record_Date order
+        record_ids = self.hit_record_ids(self.records.record_ids(selected_patient, self.record_type_combo.currentText(), *self.date_filter()))
         # print("update record id:", record_ids)
         print("select patient id:", selected_patient)
-        ## TODO: sort records with date
-        self.record_id_combo.addItems(["All"] +sorted(record_ids))
+        self.record_id_combo.addItems(["All"] + record_ids)
         self.record_id_combo.blockSignals(False)
         
 
@@ -381,16 +1090,11 @@ class AnnotationTool(QMainWindow):
         print("update_record_id_droplist_with_record_type.")
         self.record_id_combo.blockSignals(True)
         self.record_id_combo.clear()
-        if selected_type == "All":
-            self.record_id_combo.addItem("All")
-            self.record_id_combo.blockSignals(False)
-            record_ids = set(record['RecordID'] for record in self.records)
-        else:
-            record_ids = set(record['RecordID'] for record in self.records if record['Record_Type'] == selected_type)
+        ## records of the record type (and of the selected patient) from the indexes, in Record_Date order
+        record_ids = self.hit_record_ids(self.records.record_ids(self.patient_id_combo.currentText(), selected_type, *self.date_filter()))
         print("update record id:", record_ids)
         print("select record type:", selected_type)
-        ## TODO: sort records with date
-        self.record_id_combo.addItems(["All"] +sorted(record_ids))
+        self.record_id_combo.addItems(["All"] + record_ids)
         self.record_id_combo.blockSignals(False)
 
     def on_patient_id_changed(self, selected_patient):
@@ -405,6 +1109,45 @@ class AnnotationTool(QMainWindow):
         self.update_display()
 
 
+    def date_filter(self):
+        ## (start, end) of the date filter in seconds since 1970, (None, None) when it is off
+        if not self.date_filter_checkbox.isChecked():
+            return None, None
+        start = QDateTime(self.start_date.date(), QTime(0, 0, 0), Qt.UTC).toSecsSinceEpoch()
+        end = QDateTime(self.end_date.date(), QTime(23, 59, 59), Qt.UTC).toSecsSinceEpoch()
+        return start, end
+
+    def on_date_changed(self):
+        print("on_date_changed.")
+        self.update_record_id_droplist_with_patient(self.patient_id_combo.currentText())
+        self.update_display()
+
+    def apply_date_window(self):
+        ## date filter of +/- N days around the index date
+        days = self.window_days.value()
+        for date_edit, date in ((self.start_date, self.index_date.date().addDays(-days)), (self.end_date, self.index_date.date().addDays(days))):
+            date_edit.blockSignals(True)
+            date_edit.setDate(date)
+            date_edit.blockSignals(False)
+        self.date_filter_checkbox.blockSignals(True)
+        self.date_filter_checkbox.setChecked(True)
+        self.date_filter_checkbox.blockSignals(False)
+        self.on_date_changed()
+
+    def shift_date_window(self, direction):
+        ## move the index date to the closest note date before (-1) or after (1) the current window
+        start, end = self.date_filter()
+        if start is None:
+            start = QDateTime(self.index_date.date(), QTime(0, 0, 0), Qt.UTC).toSecsSinceEpoch()
+            end = start + 86399
+        value = self.records.next_date(self.patient_id_combo.currentText(), self.record_type_combo.currentText(),
+                                       start if direction < 0 else end, direction)
+        if value is None:
+            self.statusBar.showMessage("No earlier notes." if direction < 0 else "No later notes.", 3000)
+            return
+        self.index_date.setDate(QDateTime.fromSecsSinceEpoch(value, Qt.UTC).date())
+        self.apply_date_window()
+
     def update_display(self):
         print("update_display.")
         selected_patient = self.patient_id_combo.currentText()
@@ -413,26 +1156,16 @@ class AnnotationTool(QMainWindow):
         # Reset current case start time
         self.current_case_start_time = QDateTime.currentDateTime()
         
-        self.filtered_records = self.records.copy()
-        if selected_patient != "All":
-            self.filtered_records = [record for record in self.filtered_records if record['PatientID'] == selected_patient]
-        
-        if selected_record_type != "All":
-            self.filtered_records = [record for record in self.filtered_records if record['Record_Type'] == selected_record_type]
-        
-        if selected_record != "All":
-            self.filtered_records = [record for record in self.filtered_records if record['RecordID'] == selected_record]
-        
-        ## update display text
-        self.text_display.setPlainText("\n".join([self.display_format(a)[0] for a in self.filtered_records]))
-        ## record title text for highlight
-        self.title_list = [self.display_format(a)[1] for a in self.filtered_records]
+        self.stop_span_worker()
+        self.filtered_records = self.selection_rows(selected_patient, selected_record_type, selected_record)
+
+        ## large selections (e.g. "All") are shown a page of records at a time
+        self.window_start, self.window_end = 0, min(len(self.filtered_records), self.page_size_spinbox.value())
+        ## update display text and record title text for highlight, from the background rendering when it is ready
+        self.show_window(selected_patient)
         
         ## highlight
-        full_highlight = True 
-        if selected_patient == "All":
-            full_highlight = False
-        self.highlight_keywords(full_highlight)
+        self.highlight_keywords()
         # self.highlight_title()
         
         # Update annotation table based on the selected annotation level
@@ -443,6 +1176,8 @@ class AnnotationTool(QMainWindow):
             self.update_annotation_table_for_record_level()
         self.is_switching_levels = False
         
+        self.prefetch_patients()
+
         # Record start time for the current patient/record
         current_id = self.get_current_id()
         if current_id not in self.annotation_start_times:
@@ -451,23 +1186,98 @@ class AnnotationTool(QMainWindow):
         # Reset current case start time
         self.current_case_start_time = QDateTime.currentDateTime()
 
+    def show_window(self, patient_id=None):
+        ## show the records window_start..window_end of the selection, from the background rendering when it is ready.
+        ## only these records are rendered and laid out, so the cost does not grow with the size of the selection
+        self.stop_span_worker()
+        rows = self.filtered_records[self.window_start:self.window_end]
+        self.current_view = self.take_prefetched_view(patient_id, rows)
+        if self.current_view is None:
+            self.current_view = render_view(self.records, self.column_names, rows, render_cache=self.render_cache)
+        self.text_display.setPlainText(self.current_view['text'])
+        self.title_list = self.current_view['titles']
+        if self.window_end - self.window_start < len(self.filtered_records):
+            self.page_label.setText(f"Records {self.window_start + 1}-{self.window_end} of {len(self.filtered_records)}")
+        else:
+            self.page_label.setText("")
+        self.previous_page_button.setEnabled(self.window_start > 0)
+        self.next_page_button.setEnabled(self.window_end < len(self.filtered_records))
+        ## a text that fits the viewport changes no scroll range, the window is checked once it is laid out
+        self.window_timer.start()
+
+    def show_record_page(self, index):
+        ## show the page of the selection that holds its index-th record, the page starts at the top of the view
+        page_size = self.page_size_spinbox.value()
+        index = max(0, min(index, len(self.filtered_records) - 1))
+        self.window_start = index // page_size * page_size
+        self.window_end = min(self.window_start + page_size, len(self.filtered_records))
+        self.show_window()
+        self.highlight_keywords()
+
+    def on_page_settings_changed(self):
+        ## the page size or the paged mode changed, the page of the record at the top is shown and it stays at the top
+        view = self.current_view
+        if view is None:
+            return
+        index = self.window_start
+        if view['rows']:
+            index += max(0, bisect.bisect_right(view['record_starts'], self.text_display.firstVisibleBlock().position()) - 1)
+        self.show_record_page(index)
+        self.jump_to_record(index)
+
+    def move_window(self, start, end):
+        ## show another window of the selection, the record at the top of the view stays where it is
+        ## the top is kept as (record, block in the record, line in the block), the line numbers of the blocks differ
+        ## between the old and the new text
+        view = self.current_view
+        document = self.text_display.document()
+        scroll_bar = self.text_display.verticalScrollBar()
+        top_block = self.text_display.firstVisibleBlock()
+        index = max(0, bisect.bisect_right(view['record_starts'], top_block.position()) - 1)
+        top_index = self.window_start + index
+        block_offset = top_block.blockNumber() - document.findBlock(view['record_starts'][index]).blockNumber() if view['rows'] else 0
+        line_offset = scroll_bar.value() - top_block.firstLineNumber()
+        self.window_start, self.window_end = start, end
+        self.show_window()
+        self.highlight_keywords()
+        view = self.current_view
+        if not view['rows']:
+            return
+        if not start <= top_index < end:
+            top_index, block_offset, line_offset = max(start, min(top_index, end - 1)), 0, 0
+        block = document.findBlockByNumber(document.findBlock(view['record_starts'][top_index - start]).blockNumber() + block_offset)
+        self.scroll_to_position(block.position(), line_offset)
+
+    def on_text_scrolled(self):
+        ## without "Paged" the window follows the scrolling: at the end of the text the next page is added below, at
+        ## the start the previous page above, and the pages beyond VIEW_WINDOW_PAGES on the other side are dropped
+        if self.paged_checkbox.isChecked() or self.current_view is None:
+            return
+        scroll_bar = self.text_display.verticalScrollBar()
+        value = scroll_bar.value()
+        page_size = self.page_size_spinbox.value()
+        if scroll_bar.maximum() == 0:
+            ## the whole window fits the viewport, so it cannot be scrolled to its ends: pages are added on both
+            ## sides, none dropped, until it fills the viewport or holds the whole selection
+            if self.window_end < len(self.filtered_records):
+                self.move_window(self.window_start, min(self.window_end + page_size, len(self.filtered_records)))
+            elif self.window_start > 0:
+                self.move_window(max(0, self.window_start - page_size), self.window_end)
+        elif value >= scroll_bar.maximum() and self.window_end < len(self.filtered_records):
+            end = min(self.window_end + page_size, len(self.filtered_records))
+            self.move_window(max(self.window_start, end - page_size * VIEW_WINDOW_PAGES), end)
+        elif value <= scroll_bar.minimum() and self.window_start > 0:
+            start = max(0, self.window_start - page_size)
+            self.move_window(start, min(self.window_end, start + page_size * VIEW_WINDOW_PAGES))
+
     def get_current_id(self):
         if self.patient_level_radio.isChecked():
             return self.patient_id_combo.currentText()
         else:
             return self.record_id_combo.currentText()
 
-    def display_format(self, record):
-        # print("display_format.")
-        title_text = ""
-        for name in self.column_names:
-            if name != 'Record':
-                title_text += name +": " + record[name] +", "
-        title_text = title_text.strip(", ")
-        structure_text = title_text +"\n"
-        # print("display format:",structure_text)
-        structure_text += "Record:\n"+record["Record"]+"\n"
-        return structure_text, title_text
+    def display_format(self, row):
+        return format_record(self.records, self.column_names, row)
 
     def load_keyword_file(self):
         print("load_keyword_file.")
@@ -483,13 +1293,10 @@ class AnnotationTool(QMainWindow):
                     self.load_keywords[each_line.lower()] = ""
             self.extend_existing_keywords()
             self.update_keyword_table()
-            selected_patient = self.patient_id_combo.currentText()
-            full_highlight = True
-            if selected_patient == 'All':
-                full_highlight = False
-                    # Combine all keywords into a single regex pattern, using word boundaries to match whole words
+            # Combine all keywords into a single regex pattern, using word boundaries to match whole words
             self.keyword_update()
-            self.highlight_keywords(full_highlight)
+            self.highlight_keywords()
+            self.start_keyword_match()
     
     def keyword_update(self):
         keywords = [keyword for keyword in self.keyword_entry.text().split(',') if keyword.strip()]
@@ -497,7 +1304,6 @@ class AnnotationTool(QMainWindow):
         if self.power_highlight_checkbox.isChecked():  # power highlight model
             keywords += self.extend_keywords
         self.keywords = list(set([keyword.strip().lower() for keyword in keywords]))
-        self.match_pattern = r'|'.join(re.escape(keyword.lower()) for keyword in set(self.keywords))
     
     
     def extend_existing_keywords(self):
@@ -518,7 +1324,7 @@ class AnnotationTool(QMainWindow):
     def update_status_bar(self):
         # print("update status bar.")
         # Update patient count
-        total_patients = len(set(record['PatientID'] for record in self.records))
+        total_patients = self.records.patient_count()
         self.patient_count_label.setText(f"Total Patients: {total_patients}")
 
         # Update record count
@@ -543,103 +1349,40 @@ class AnnotationTool(QMainWindow):
         case_time_str = f"{case_hours:02d}:{case_minutes:02d}:{case_seconds:02d}"
         self.current_case_time_label.setText(f"Current Case Time: {case_time_str}")
 
-    # # Modify the highlight_keywords method to use threading
-    # def highlight_keywords(self, full_highlight=True):
-    #     start_time = time.time()
-    #     print("     Highlight keywords, highlight all:", full_highlight, ", keyword number:", len(self.keywords))
-        
-    #     if len(self.keywords) > 0 and full_highlight:
-    #         # Clear previous highlights
-    #         cursor = self.text_display.textCursor()
-    #         cursor.select(QTextCursor.Document)
-    #         cursor.setCharFormat(QTextCharFormat())  # Reset the format
-    #         cursor.clearSelection()
-
-    #         # Define highlight format
-    #         highlight_format = QTextCharFormat()
-    #         highlight_format.setForeground(QColor(Qt.red))
-
-    #         # Get the entire document text and convert to lowercase for searching
-    #         document = self.text_display.document()
-
-    #         # Create and start a worker thread for highlighting
-    #         self.highlight_worker = HighlightWorker(document, self.match_pattern, highlight_format)
-    #         self.highlight_worker.finished.connect(self.on_highlight_finished)  # Connect the signal to a slot
-    #         self.highlight_worker.start()  # Start the worker thread
-
-    # def on_highlight_finished(self, time_cost):
-    #     print(f"        Highlight keywords complete. Time cost: {time_cost:.4f} seconds.")
-    #     self.highlight_title(True)  # Assuming `highlight_title` is part of the main UI update
-
-    def highlight_keywords(self, full_highlight=True):
+    def highlight_keywords(self):
         start_time = time.time()
-        print("     Highlight keywords, highlight all:", full_highlight, ", keyword number:", len(self.keywords))
-        if len(self.keywords) >0  and (full_highlight != False or type(full_highlight) != type(False)):
-            # Clear previous highlights
-            cursor = self.text_display.textCursor()
-            cursor.select(QTextCursor.Document)
-            cursor.setCharFormat(QTextCharFormat())
-            cursor.clearSelection()
-
-            # Define highlight format
-            highlight_format = QTextCharFormat()
-            highlight_format.setForeground(QColor(Qt.red))
-
-            # Get the entire document text and convert to lowercase for searching
-            document = self.text_display.document()
-            text = document.toPlainText().lower()
-            
-            # text_length = len(text)
-            # text = text[:min(text_length, 10000)]
-            cursor = QTextCursor(document)
-            # Highlight keywords
-            for keyword in set(self.keywords):
-                start_index = 0
-                while True:
-                    index = text.find(keyword, start_index)
-                    if index == -1:
-                        break
-                    # Select and highlight the original text (preserving case)
-                    cursor.setPosition(index)
-                    cursor.movePosition(QTextCursor.Right, QTextCursor.KeepAnchor, len(keyword))
-                    cursor.mergeCharFormat(highlight_format)
-                    start_index = index + len(keyword)
+        print("     Highlight keywords, keyword number:", len(self.keywords))
+        # Define highlight format
+        highlight_format = QTextCharFormat()
+        highlight_format.setForeground(QColor(Qt.red))
+        # Highlight keywords, the highlighter draws the spans of the text blocks as they are scrolled into view,
+        # so the "All" view is highlighted as well, at the cost of the shown blocks only
+        self.stop_span_worker()
+        previous = self.previous_keyword_spans()
+        spans = self.view_keyword_spans(self.keywords)
+        if previous is None:
+            self.text_highlighter.set_layer('keywords', highlight_format, spans)
+        elif not callable(spans):
+            self.text_highlighter.update_spans('keywords', spans)
+        ## else the previous keyword spans stay shown until the span worker updated them for the changed keywords
         time_cost = time.time() - start_time
         print(f"     Highlight keywords complete. Time cost: {time_cost:.4f} seconds.")
         
-        self.highlight_title(full_highlight)
+        self.highlight_title()
+        self.highlight_search_hits()
+        self.start_span_worker(self.keywords, previous)
 
-    def highlight_title(self, full_highlight):
+    def highlight_title(self):
         start_time = time.time()
-        print("     Highlight_title,  highlight all: ", full_highlight)
+        print("     Highlight_title.")
         # Define highlight format
         highlight_format = QTextCharFormat()
         highlight_format.setBackground(QColor(Qt.yellow))
-        # Get the entire document text
-        document = self.text_display.document()
-        text = document.toPlainText()
-        # Split the text into lines
-        lines = text.split('\n')
-        cursor = QTextCursor(document)
-        # Track the starting position of each line
-        current_position = 0  # Start position at the beginning of the document
-        # Highlight lines that start with "PatientID: "
-        for line_number, line in enumerate(lines):
-            if full_highlight:
-                if line.startswith("PatientID: "):
-                    # Calculate the start index of the current line
-                    start_index = current_position
-                    # Select and highlight the entire line
-                    cursor.setPosition(start_index)
-                    cursor.movePosition(QTextCursor.Right, QTextCursor.KeepAnchor, len(line))
-                    cursor.mergeCharFormat(highlight_format)
-
-            # Update `current_position` to the start index of the next line
-            current_position += len(line) + 1  # +1 to account for the newline character
+        # Highlight the title line of each record, from the offset table of the view
+        self.text_highlighter.set_layer('titles', highlight_format, self.view_title_spans())
         time_cost = time.time() - start_time
         print(f"     Highlighting title complete. Time cost: {time_cost:.4f} seconds.")
 
-                
     ## event for annotation change
     def on_annotation_level_changed(self):
         print("Annotation level changing")  # Debug print
@@ -661,25 +1404,12 @@ class AnnotationTool(QMainWindow):
     def update_annotation_table_for_patient_level(self):
         self.set_annotation_table_headers(True)
         self.annotation_table.setRowCount(0)
-        patient_data = {}
-
-        for record in self.filtered_records:
-            patient_id = record['PatientID']
-            if patient_id not in patient_data:
-                patient_data[patient_id] = {
-                    'record_count': 0,
-                    'start_date': record['Record_Date'],
-                    'end_date': record['Record_Date']
-                }
-            else:
-                patient_data[patient_id]['record_count'] += 1
-                patient_data[patient_id]['start_date'] = min(patient_data[patient_id]['start_date'], record['Record_Date'])
-                patient_data[patient_id]['end_date'] = max(patient_data[patient_id]['end_date'], record['Record_Date'])
+        patient_data = self.records.patient_summaries(self.filtered_records)
 
         for i, (patient_id, data) in enumerate(sorted(patient_data.items())):
             self.annotation_table.insertRow(i)
             self.annotation_table.setItem(i, 0, QTableWidgetItem(patient_id))
-            self.annotation_table.setItem(i, 1, QTableWidgetItem(str(data['record_count'] + 1)))
+            self.annotation_table.setItem(i, 1, QTableWidgetItem(str(data['record_count'])))
             self.annotation_table.setItem(i, 2, QTableWidgetItem(data['start_date']))
             self.annotation_table.setItem(i, 3, QTableWidgetItem(data['end_date']))
             
@@ -691,15 +1421,16 @@ class AnnotationTool(QMainWindow):
     def update_annotation_table_for_record_level(self):
         self.set_annotation_table_headers(False)
         self.annotation_table.setRowCount(0)
-        for i, record in enumerate(self.filtered_records):
+        for i, row in enumerate(self.filtered_records):
+            record_id = self.records.record_id(row)
             self.annotation_table.insertRow(i)
-            self.annotation_table.setItem(i, 0, QTableWidgetItem(record['PatientID']))
-            self.annotation_table.setItem(i, 1, QTableWidgetItem(record['RecordID']))
-            self.annotation_table.setItem(i, 2, QTableWidgetItem(record['Record_Date']))
-            self.annotation_table.setItem(i, 3, QTableWidgetItem(record['Record_Type']))
+            self.annotation_table.setItem(i, 0, QTableWidgetItem(self.records.patient_id(row)))
+            self.annotation_table.setItem(i, 1, QTableWidgetItem(record_id))
+            self.annotation_table.setItem(i, 2, QTableWidgetItem(self.records.record_date(row)))
+            self.annotation_table.setItem(i, 3, QTableWidgetItem(self.records.record_type(row)))
             
             # Retrieve stored annotation data
-            annotation_data = self.record_annotations.get(record['RecordID'], {})
+            annotation_data = self.record_annotations.get(record_id, {})
             for col, header in enumerate(self.record_headers[4:-1]):  # Start from 'Annotation Start', exclude '+'
                 self.annotation_table.setItem(i, col + 4, QTableWidgetItem(annotation_data.get(header, '')))
 
@@ -836,30 +1567,15 @@ class AnnotationTool(QMainWindow):
                     # Save patient-level annotations (grouped by patient)
                     if self.patient_level_radio.isChecked():
                         # Gather data for each patient
-                        patient_data = {}
-
-                        for record in self.records:
-                            patient_id = record['PatientID']
-                            if patient_id not in patient_data:
-                                # Initialize patient-level data with the first record's details
-                                patient_data[patient_id] = {
-                                    'Record Count': 1,
-                                    'Start Date': record['Record_Date'],
-                                    'End Date': record['Record_Date']
-                                }
-                            else:
-                                # Update record count, start date, and end date for this patient
-                                patient_data[patient_id]['Record Count'] += 1
-                                patient_data[patient_id]['Start Date'] = min(patient_data[patient_id]['Start Date'], record['Record_Date'])
-                                patient_data[patient_id]['End Date'] = max(patient_data[patient_id]['End Date'], record['Record_Date'])
+                        patient_data = self.records.patient_summaries()
 
                         # Write patient-level data to CSV
                         for patient_id, data in patient_data.items():
                             row_data = [
                                 patient_id,
-                                str(data['Record Count']),
-                                data['Start Date'],
-                                data['End Date']
+                                str(data['record_count']),
+                                data['start_date'],
+                                data['end_date']
                             ]
 
                             # Add annotation data if available, else empty
@@ -871,16 +1587,16 @@ class AnnotationTool(QMainWindow):
 
                     # Save record-level annotations (for each individual record)
                     else:
-                        for record in self.records:
-                            patient_id = record['PatientID']
-                            record_id = record['RecordID']
+                        for row in range(len(self.records)):
+                            patient_id = self.records.patient_id(row)
+                            record_id = self.records.record_id(row)
 
                             # Default data for record
                             row_data = [
                                 patient_id,
                                 record_id,
-                                record.get('Record_Date', ''),
-                                record.get('Record_Type', '')
+                                self.records.record_date(row),
+                                self.records.record_type(row)
                             ]
 
                             # Add annotation data if exists, else empty
@@ -936,6 +1652,11 @@ class AnnotationTool(QMainWindow):
                 # Restore project data
                 self.records = project_data['records']
                 self.filtered_records = project_data['filtered_records']
+                if isinstance(self.records, list):  # project saved before the columnar record store
+                    self.records = RecordStore()
+                    self.records.extend(project_data['records'])
+                    self.filtered_records = list(range(len(self.records)))
+                self.column_names = self.records.column_names
                 self.patient_annotations = project_data['patient_annotations']
                 self.record_annotations = project_data['record_annotations']
                 self.title_list = project_data['title_list']
@@ -994,52 +1715,7 @@ class AnnotationTool(QMainWindow):
     #                     row_data.append(item.text() if item else '')
     #                 csv_writer.writerow(row_data)
 
-# Define a worker class for highlighting
-import re
-
-class HighlightWorker(QThread):
-    finished = pyqtSignal(float)  # Signal to indicate the thread has finished, with time cost as parameter
-
-    def __init__(self, document, keyword_pattern, highlight_format):
-        super().__init__()
-        self.document = document
-        self.highlight_format = highlight_format
-        self.keyword_pattern = keyword_pattern
-
-    def run(self):
-        # Perform the highlighting operation
-        start_time = time.time()
-
-        # Get the original text and the length
-        original_text = self.document.toPlainText()
-        text_lower = original_text.lower()  # Lowercased version for keyword searching
-        text_length = len(original_text)  # Get the total length of the document
-
-
-
-        # Find all occurrences of keywords in one pass
-        matches = list(re.finditer(self.keyword_pattern, text_lower))
-        
-        # Create a cursor for the document
-        cursor = QTextCursor(self.document)
-
-        # Iterate through the matches and highlight them
-        for match in matches:
-            start_index = match.start()  # Get start position of the match
-            keyword = match.group()      # Get the matched keyword text
-
-            # Set the cursor to the start position and select the keyword
-            cursor.setPosition(start_index)
-            cursor.movePosition(QTextCursor.Right, QTextCursor.KeepAnchor, len(keyword))
-
-            # Apply the highlight format
-            cursor.mergeCharFormat(self.highlight_format)
-
-        time_cost = time.time() - start_time
-        self.finished.emit(time_cost)  # Emit the signal when done
-
-
-class AnnotationTextEdit(QTextEdit):
+class AnnotationTextEdit(QPlainTextEdit):  # plain text layout, blocks are laid out and highlighted on their own
     def __init__(self, parent):
         super().__init__(parent)
         self.parent = parent
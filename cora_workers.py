@@ -0,0 +1,286 @@
+'''
+ # @ Author: Jie Yang
+ # @ Create Time: 2024.6
+ # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
+ '''
+# -*- coding: utf-8 -*-
+## background workers shared by the CORA annotation tools
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from PyQt5.QtCore import QThread, pyqtSignal
+from cora_reader import dataset_lazy_columns, iter_file_rows, scan_shard, shard_bases
+from cora_search import SearchIndex, load_search_index, save_search_index
+from cora_render import render_view, keyword_matcher, record_keyword_spans, changed_keyword_spans
+
+
+class LoadWorker(QThread):
+    ## scan a file in a worker thread and stream the records back to the UI in batches.
+    ## only the metadata columns are read, note bodies stay in the file and are located by their row range.
+    ## compressed and csv files are decoded on the fly and their note bodies are read along with the metadata
+    batch_loaded = pyqtSignal(object, object)  # record dicts of the batch, (start, end) range of each row in the file. passed as they are, as list each dict would become a QVariantMap with sorted keys
+    progress = pyqtSignal(int, 'qint64', 'qint64')  # rows read, bytes read, total bytes
+    load_finished = pyqtSignal(int, bool)  # total rows, cancelled
+    load_failed = pyqtSignal(str)
+    resume_failed = pyqtSignal()  # the last loaded row is no longer where it was, the file was not only appended to
+
+    def __init__(self, file_path, batch_size=1000, batch_interval=0.25, resume=None, lazy_columns=None):
+        super().__init__()
+        self.file_path = file_path
+        self.lazy_columns = lazy_columns  # columns read back through the row source, of the file alone by default
+        self.batch_size = batch_size  # max records per batch
+        self.batch_interval = batch_interval  # max seconds between two batches, keeps the first patient quick to show
+        self.resume = resume  # (start, RecordID) of the last loaded row, only the rows after it are loaded
+
+    def run(self):
+        total_bytes = os.path.getsize(self.file_path)
+        batch = []
+        spans = []
+        row_count = 0
+        last_emit = time.time()
+        try:
+            with open(self.file_path, 'rb') as f:
+                rows = iter_file_rows(f, self.file_path, resume=self.resume[0] if self.resume else 0, lazy_columns=self.lazy_columns)
+                if self.resume is not None:
+                    ## the scan starts at the last loaded row, check it is still the same record
+                    try:
+                        first_row = next(rows, None)
+                    except Exception:  # resume offset is no longer at a row
+                        first_row = None
+                    if first_row is None or first_row[0].get('RecordID', '') != self.resume[1]:
+                        self.resume_failed.emit()
+                        return
+                for record, start, end in rows:
+                    if self.isInterruptionRequested():
+                        break
+                    batch.append(record)
+                    spans.append((start, end))
+                    row_count += 1
+                    if len(batch) >= self.batch_size or time.time() - last_emit >= self.batch_interval:
+                        self.batch_loaded.emit(batch, spans)
+                        self.progress.emit(row_count, f.tell(), total_bytes)
+                        batch = []
+                        spans = []
+                        last_emit = time.time()
+                if batch:
+                    self.batch_loaded.emit(batch, spans)
+                self.progress.emit(row_count, f.tell(), total_bytes)
+        except Exception as e:
+            self.load_failed.emit(str(e))
+            return
+        self.load_finished.emit(row_count, self.isInterruptionRequested())
+
+
+class ShardLoadWorker(QThread):
+    ## scan a folder of data file shards in parallel with a process pool and merge them, in file order,
+    ## into one stream of batches. Same signals as LoadWorker, row ranges are relative to the
+    ## shards seen as one file (cora_reader.MultiRowSource). Rows whose RecordID was already
+    ## loaded from an earlier shard are skipped and reported.
+    batch_loaded = pyqtSignal(object, object)
+    progress = pyqtSignal(int, 'qint64', 'qint64')
+    load_finished = pyqtSignal(int, bool)
+    load_failed = pyqtSignal(str)
+    duplicates_found = pyqtSignal(list)  # (RecordID, shard file) of the skipped rows
+
+    def __init__(self, file_paths, batch_size=1000, max_workers=None):
+        super().__init__()
+        self.file_paths = list(file_paths)
+        self.batch_size = batch_size
+        self.max_workers = max_workers or min(len(self.file_paths), os.cpu_count() or 1)
+
+    def run(self):
+        bases = shard_bases(self.file_paths)
+        sizes = [os.path.getsize(file_path) for file_path in self.file_paths]
+        total_bytes = sum(sizes)
+        seen_record_ids = set()
+        duplicates = []
+        row_count = 0
+        cancelled = False
+        ## spawn, forking a process that runs Qt threads is not safe
+        executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            lazy_columns = dataset_lazy_columns(self.file_paths)
+            futures = [executor.submit(scan_shard, file_path, lazy_columns) for file_path in self.file_paths]
+            for index, future in enumerate(futures):
+                while not future.done() and not self.isInterruptionRequested():
+                    wait([future], timeout=0.2)
+                if self.isInterruptionRequested():
+                    cancelled = True
+                    break
+                records, starts, ends = future.result()
+                base = bases[index]
+                batch = []
+                spans = []
+                for record, start, end in zip(records, starts, ends):
+                    record_id = record.get('RecordID', '')
+                    if record_id in seen_record_ids:
+                        duplicates.append((record_id, self.file_paths[index]))
+                        continue
+                    seen_record_ids.add(record_id)
+                    row_count += 1
+                    batch.append(record)
+                    spans.append((base + start, base + end))
+                    if len(batch) >= self.batch_size:
+                        self.batch_loaded.emit(batch, spans)
+                        batch = []
+                        spans = []
+                if batch:
+                    self.batch_loaded.emit(batch, spans)
+                self.progress.emit(row_count, sum(sizes[:index + 1]), total_bytes)
+        except Exception as e:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.load_failed.emit(str(e))
+            return
+        ## on cancel the shards not yet started are dropped, the scans already running are abandoned: the pool
+        ## processes finish them in the background and their results are discarded
+        executor.shutdown(wait=not cancelled, cancel_futures=cancelled)
+        if duplicates:
+            self.duplicates_found.emit(duplicates)
+        self.load_finished.emit(row_count, cancelled)
+
+
+class SearchIndexWorker(QThread):
+    ## build the full-text search index of the loaded records in a worker thread and save it next to the dataset.
+    ## indexing continues from the given index (rows appended since it was built) or from the saved index of
+    ## the dataset, rows are read through a copy of the store with its own handle on the file
+    progress = pyqtSignal(int, int)  # rows indexed, total rows
+    index_finished = pyqtSignal(object)  # SearchIndex of all loaded rows
+
+    def __init__(self, records, dataset_path, search_index=None, progress_interval=0.5):
+        super().__init__()
+        self.records = records
+        self.dataset_path = dataset_path
+        self.fingerprint = records.fingerprint
+        self.search_index = search_index
+        self.progress_interval = progress_interval
+
+    def run(self):
+        reader = self.records.reader()
+        try:
+            index = self.search_index
+            if index is None:
+                index = load_search_index(self.dataset_path, self.fingerprint)
+            if index is None or len(index) > len(reader):
+                index = SearchIndex()
+            start = len(index)
+            last_emit = time.time()
+            for row in range(start, len(reader)):
+                if self.isInterruptionRequested():
+                    return
+                index.add(reader.record_text(row), reader.patient_id(row))
+                if time.time() - last_emit >= self.progress_interval:
+                    self.progress.emit(row + 1, len(reader))
+                    last_emit = time.time()
+            if len(index) > start or index.fingerprint != self.fingerprint:
+                index.fingerprint = self.fingerprint
+                save_search_index(index, self.dataset_path)
+        except Exception as e:
+            print("Failed to build search index:", e)
+            return
+        finally:
+            reader.close()
+        self.index_finished.emit(index)
+
+
+class KeywordMatchWorker(QThread):
+    ## find the rows whose note body contains a keyword, in a worker thread. keyword_rows have a hit of the
+    ## keyword list, power_rows only a hit of the power highlight keywords, so toggling power highlight needs no rescan.
+    ## with a start_row only the rows from it on are scanned, e.g. the rows appended by a refresh
+    progress = pyqtSignal(int, int)  # rows scanned, total rows
+    matches_found = pyqtSignal(set, set)  # keyword_rows, power_rows
+
+    def __init__(self, records, keywords, power_keywords, whole_word=False, progress_interval=0.5, start_row=0):
+        super().__init__()
+        self.records = records
+        self.keywords = keywords
+        self.power_keywords = power_keywords
+        self.whole_word = whole_word
+        self.progress_interval = progress_interval
+        self.start_row = start_row
+        self.row_count = None  # rows of the store when the scan started, the hits cover the rows up to it
+
+    def keyword_matcher(self, keywords):
+        ## same matching as the highlighting: case-insensitive occurrence in the note
+        keywords = {keyword.strip().lower() for keyword in keywords if keyword.strip()}
+        return keyword_matcher(keywords, self.whole_word) if keywords else None
+
+    def run(self):
+        matcher = self.keyword_matcher(self.keywords)
+        power_matcher = self.keyword_matcher(self.power_keywords)
+        keyword_rows = set()
+        power_rows = set()
+        reader = self.records.reader()
+        try:
+            last_emit = time.time()
+            self.row_count = len(reader)
+            for row in range(self.start_row, self.row_count):
+                if self.isInterruptionRequested():
+                    return
+                text = reader.record_text(row)
+                if matcher is not None and matcher.search(text):
+                    keyword_rows.add(row)
+                elif power_matcher is not None and power_matcher.search(text):
+                    power_rows.add(row)
+                if time.time() - last_emit >= self.progress_interval:
+                    self.progress.emit(row + 1 - self.start_row, self.row_count - self.start_row)
+                    last_emit = time.time()
+        except Exception as e:
+            print("Failed to match keywords:", e)
+            return
+        finally:
+            reader.close()
+        self.matches_found.emit(keyword_rows, power_rows)
+
+
+class PrefetchWorker(QThread):
+    ## render the views of the patients the annotator is likely to open next (text, titles and highlight spans),
+    ## so that opening them only has to show the text and apply the spans
+    view_rendered = pyqtSignal(str, object)  # PatientID, view of cora_render.render_view
+
+    def __init__(self, records, column_names, selections, keywords, whole_word=False, span_cache=None, render_cache=None):
+        super().__init__()
+        self.records = records
+        self.column_names = column_names
+        self.selections = selections  # (PatientID, rows to show)
+        self.keywords = keywords
+        self.whole_word = whole_word
+        self.span_cache = span_cache
+        self.render_cache = render_cache
+
+    def run(self):
+        reader = self.records.reader()
+        try:
+            for patient_id, rows in self.selections:
+                if self.isInterruptionRequested():
+                    return
+                self.view_rendered.emit(patient_id, render_view(reader, self.column_names, rows, self.keywords, self.whole_word, self.span_cache, self.render_cache))
+        except Exception as e:
+            print("Failed to prefetch patients:", e)
+        finally:
+            reader.close()
+
+
+class SpanWorker(QThread):
+    ## keyword spans of a shown view that was not rendered with them, in a worker thread. it only reads the text of
+    ## the view, the GUI thread stores the spans and hands them to the highlighter. keywords are matched per record
+    ## (and kept in the span cache), so an interruption stops it quickly
+    spans_ready = pyqtSignal(object, object)  # view, keyword spans
+
+    def __init__(self, view, keywords, whole_word=False, span_cache=None, previous=None):
+        super().__init__()
+        self.view = view
+        self.keywords = keywords
+        self.whole_word = whole_word
+        self.span_cache = span_cache
+        self.previous = previous  # (keywords, spans) of the view before the keywords changed, only the change is searched
+
+    def run(self):
+        matcher = keyword_matcher(self.keywords, self.whole_word)
+        if self.previous is not None:
+            keyword_spans = changed_keyword_spans(self.view, matcher, self.previous, self.span_cache, self.isInterruptionRequested)
+        else:
+            keyword_spans = record_keyword_spans(self.view, matcher, self.span_cache, interrupted=self.isInterruptionRequested)
+        if keyword_spans is None:
+            return
+        self.spans_ready.emit(self.view, keyword_spans)
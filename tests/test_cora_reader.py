@@ -0,0 +1,61 @@
+'''
+ # @ Author: Jie Yang
+ # @ Create Time: 2024.6
+ # @ Last Modified by: Jie Yang  Contact: jieynlp@gmail.com
+ '''
+# -*- coding: utf-8 -*-
+## loading a folder of shards the way ShardLoadWorker does, without the process pool
+import os
+import sys
+import gzip
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cora_reader import dataset_lazy_columns, open_row_source, scan_shard, shard_bases
+from cora_store import RecordStore
+
+
+def write_shard(file_path, rows):
+    text = "<CORA_xml>\n"
+    for patient_id, record_id, note in rows:
+        text += ('    <ROW>\n'
+                 f'        <COLUMN NAME="PatientID"> {patient_id}</COLUMN>\n'
+                 f'        <COLUMN NAME="RecordID"> {record_id}</COLUMN>\n'
+                 '        <COLUMN NAME="Record_Date"> 2024-01-01 00:00:00</COLUMN>\n'
+                 '        <COLUMN NAME="Record_Type"> PRG</COLUMN>\n'
+                 f'        <COLUMN NAME="Record"> {note}</COLUMN>\n'
+                 '    </ROW>\n')
+    text += "</CORA_xml>\n"
+    data = text.encode('utf-8')
+    if file_path.endswith('.gz'):
+        data = gzip.compress(data)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+
+def load_folder(file_paths):
+    store = RecordStore(open_row_source(file_paths))
+    lazy_columns = dataset_lazy_columns(file_paths)
+    for base, file_path in zip(shard_bases(file_paths), file_paths):
+        records, starts, ends = scan_shard(file_path, lazy_columns)
+        store.extend(records, [(base + start, base + end) for start, end in zip(starts, ends)])
+    return store
+
+
+def test_mixed_plain_and_compressed_shards(tmp_path):
+    file_paths = [str(tmp_path / 'a.xml'), str(tmp_path / 'b.xml.gz'), str(tmp_path / 'c.xml')]
+    write_shard(file_paths[0], [('P1', 'R1', 'first note'), ('P1', 'R2', 'second note')])
+    write_shard(file_paths[1], [('P2', 'R3', 'compressed note')])
+    write_shard(file_paths[2], [('P3', 'R4', 'last note')])
+    store = load_folder(file_paths)
+    assert dataset_lazy_columns(file_paths) == ()
+    assert store.source is None
+    assert [store.record_text(row).strip() for row in range(len(store))] == ['first note', 'second note', 'compressed note', 'last note']
+
+
+def test_plain_shards_read_lazily(tmp_path):
+    file_paths = [str(tmp_path / 'a.xml'), str(tmp_path / 'b.xml')]
+    write_shard(file_paths[0], [('P1', 'R1', 'first note')])
+    write_shard(file_paths[1], [('P2', 'R2', 'second note')])
+    store = load_folder(file_paths)
+    assert dataset_lazy_columns(file_paths) == ('Record',)
+    assert store.source is not None
+    assert [store.record_text(row).strip() for row in range(len(store))] == ['first note', 'second note']